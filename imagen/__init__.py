@@ -13,9 +13,11 @@ from __future__ import with_statement
 __version__='$Revision$'
 
 
+from functools import partial
+
 import numpy
 from numpy.oldnumeric import around, bitwise_and, bitwise_or
-from numpy import abs, add, alltrue, array, ceil, clip, cos, fft, flipud, \
+from numpy import abs, add, array, ceil, clip, cos, divide, fft, flipud, \
         floor, fmod, exp, hstack, Infinity, linspace, multiply, nonzero, pi, \
         repeat, sin, sqrt, subtract, tile, zeros, sum, max
 
@@ -24,15 +26,21 @@ from param.parameterized import ParamOverrides
 from param import ClassSelector
 
 # Imported here so that all PatternGenerators will be in the same package
-from patterngenerator import Constant, PatternGenerator
+from patterngenerator import Constant, PatternGenerator, as_float_dtype, _uses_base_call, \
+    _draw_concurrently, _can_fork, _dtype_key, _hashable, LRUCache
+from patterngenerator import KernelBank, PatternMemo, Transform # pyflakes:ignore (API import)
+
+from numbergen import BinaryOperator, BoundedNumber, CompiledExpression, NumberGenerator, \
+    TimeAware, UnaryOperator, _time_fixed
 
 from dataviews import SheetStack
+from dataviews.boundingregion import BoundingBox
 from dataviews.sheetcoords import SheetCoordinateSystem
 from dataviews import boundingregion, sheetcoords # pyflakes:ignore (API import)
 
 from patternfn import gaussian,exponential,gabor,line,disk,ring,\
     sigmoid,arc_by_radian,arc_by_center,smooth_rectangle,float_error_ignore, \
-    log_gaussian
+    log_gaussian,gaussian_extent,gaussian_profile,smooth_edge
 
 import numbergen
 from imagen.transferfn import DivisiveNormalizeL1
@@ -50,6 +58,8 @@ class HalfPlane(PatternGenerator):
     with optional Gaussian smoothing.
     """
 
+    _batch_vectorized = True
+
     smoothing = param.Number(default=0.02,bounds=(0.0,None),softbounds=(0.0,0.5),
                              precedence=0.61,doc="Width of the Gaussian fall-off.")
 
@@ -79,6 +89,9 @@ class Gaussian(PatternGenerator):
       exp(-x^2/(2*xsigma^2) - y^2/(2*ysigma^2)
     """
 
+    _batch_vectorized = True
+    _function_out = True
+
     aspect_ratio = param.Number(default=1/0.31,bounds=(0.0,None),softbounds=(0.0,6.0),
         precedence=0.31,doc="""
         Ratio of the width to the height.
@@ -89,11 +102,23 @@ class Gaussian(PatternGenerator):
         exp(-x^2/(2*xsigma^2) - y^2/(2*ysigma^2)
         where ysigma=size/2 and xsigma=size/2*aspect_ratio.""")
 
-    def function(self,p):
+    def function(self,p,out=None):
         ysigma = p.size/2.0
         xsigma = p.aspect_ratio*ysigma
 
-        return gaussian(self.pattern_x,self.pattern_y,xsigma,ysigma)
+        return gaussian(self.pattern_x,self.pattern_y,xsigma,ysigma,
+                        out,self._scratch('work',out))
+
+    def _support(self,p):
+        ysigma = p.size/2.0
+        xsigma = p.aspect_ratio*ysigma
+        return (gaussian_extent(xsigma,p.support_tolerance),
+                gaussian_extent(ysigma,p.support_tolerance))
+
+    def _separable(self,p,x,y):
+        ysigma = p.size/2.0
+        xsigma = p.aspect_ratio*ysigma
+        return (gaussian_profile(x,xsigma),gaussian_profile(y,ysigma),multiply)
 
 
 class ExponentialDecay(PatternGenerator):
@@ -113,6 +138,8 @@ class ExponentialDecay(PatternGenerator):
       exp(-sqrt((x/xscale)^2 - (y/yscale)^2))
     """
 
+    _batch_vectorized = True
+
     aspect_ratio = param.Number(default=1/0.31,bounds=(0.0,None),softbounds=(0.0,2.0),
         precedence=0.31,doc="""Ratio of the width to the height.""")
 
@@ -129,21 +156,37 @@ class ExponentialDecay(PatternGenerator):
 class SineGrating(PatternGenerator):
     """2D sine grating pattern generator."""
 
+    _batch_vectorized = True
+    _function_out = True
+
     frequency = param.Number(default=2.4,bounds=(0.0,None),softbounds=(0.0,10.0),
                        precedence=0.50, doc="Frequency of the sine grating.")
 
     phase     = param.Number(default=0.0,bounds=(0.0,None),softbounds=(0.0,2*pi),
                        precedence=0.51,doc="Phase of the sine grating.")
 
-    def function(self,p):
+    def function(self,p,out=None):
         """Return a sine grating pattern (two-dimensional sine wave)."""
-        return 0.5 + 0.5*sin(p.frequency*2*pi*self.pattern_y + p.phase)
+        if out is None:
+            return 0.5 + 0.5*sin(p.frequency*2*pi*self.pattern_y + p.phase)
+
+        multiply(self.pattern_y,p.frequency*2*pi,out)
+        add(out,p.phase,out)
+        sin(out,out)
+        multiply(out,0.5,out)
+        return add(out,0.5,out)
+
+    def _separable(self,p,x,y):
+        return (None,0.5 + 0.5*sin(p.frequency*2*pi*y + p.phase),None)
 
 
 
 class Gabor(PatternGenerator):
     """2D Gabor pattern generator."""
 
+    _batch_vectorized = True
+    _function_out = True
+
     frequency = param.Number(default=2.4,bounds=(0.0,None),softbounds=(0.0,10.0),
         precedence=0.50,doc="Frequency of the sine grating component.")
 
@@ -160,17 +203,36 @@ class Gabor(PatternGenerator):
     size = param.Number(default=0.25,doc="""
         Determines the height of the Gaussian component (see Gaussian).""")
 
-    def function(self,p):
+    def function(self,p,out=None):
         height = p.size/2.0
         width = p.aspect_ratio*height
 
         return gabor(self.pattern_x,self.pattern_y,width,height,
-                     p.frequency,p.phase)
+                     p.frequency,p.phase,out,self._scratch('work',out))
+
+    def _support(self,p):
+        # Bounded by the Gaussian envelope
+        height = p.size/2.0
+        width = p.aspect_ratio*height
+        return (gaussian_extent(width,p.support_tolerance),
+                gaussian_extent(height,p.support_tolerance))
+
+    def _separable(self,p,x,y):
+        height = p.size/2.0
+        width = p.aspect_ratio*height
+        if width==0.0 or height==0.0:
+            return None
+        return (gaussian_profile(x,width),
+                gaussian_profile(y,height)*0.5*cos(2*pi*p.frequency*y + p.phase),
+                multiply)
 
 
 class Line(PatternGenerator):
     """2D line pattern generator."""
 
+    _batch_vectorized = True
+    _function_out = True
+
     thickness   = param.Number(default=0.006,bounds=(0.0,None),softbounds=(0.0,1.0),
                          precedence=0.60,
                          doc="Thickness (width) of the solid central part of the line.")
@@ -178,8 +240,12 @@ class Line(PatternGenerator):
                        precedence=0.61,
                        doc="Width of the Gaussian fall-off.")
 
-    def function(self,p):
-        return line(self.pattern_y,p.thickness,p.smoothing)
+    def function(self,p,out=None):
+        return line(self.pattern_y,p.thickness,p.smoothing,out)
+
+    def _support(self,p):
+        return (float('inf'),
+                p.thickness/2.0+gaussian_extent(p.smoothing,p.support_tolerance))
 
 
 class Disk(PatternGenerator):
@@ -195,6 +261,9 @@ class Disk(PatternGenerator):
     the point on the circle before stretching that was closest to P.
     """
 
+    _batch_vectorized = True
+    _function_out = True
+
     aspect_ratio  = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,2.0),
         precedence=0.31,doc=
         "Ratio of width to height; size*aspect_ratio gives the width of the disk.")
@@ -204,14 +273,24 @@ class Disk(PatternGenerator):
     smoothing = param.Number(default=0.1,bounds=(0.0,None),softbounds=(0.0,0.5),
                        precedence=0.61,doc="Width of the Gaussian fall-off")
 
-    def function(self,p):
+    def function(self,p,out=None):
         height = p.size
 
         if p.aspect_ratio==0.0:
             return self.pattern_x*0.0
 
-        return disk(self.pattern_x/p.aspect_ratio,self.pattern_y,height,
-                    p.smoothing)
+        if out is None:
+            return disk(self.pattern_x/p.aspect_ratio,self.pattern_y,height,
+                        p.smoothing)
+
+        # disk() has finished with x by the time it writes to work
+        work = self._scratch('work',out)
+        return disk(divide(self.pattern_x,p.aspect_ratio,work),self.pattern_y,
+                    height,p.smoothing,out,work)
+
+    def _support(self,p):
+        radius = p.size/2.0+gaussian_extent(p.smoothing,p.support_tolerance)
+        return (p.aspect_ratio*radius,radius)
 
 
 class Ring(PatternGenerator):
@@ -221,6 +300,8 @@ class Ring(PatternGenerator):
     See the Disk class for a note about the Gaussian fall-off.
     """
 
+    _batch_vectorized = True
+
     thickness = param.Number(default=0.015,bounds=(0.0,None),softbounds=(0.0,0.5),
         precedence=0.60,doc="Thickness (line width) of the ring.")
 
@@ -241,6 +322,10 @@ class Ring(PatternGenerator):
         return ring(self.pattern_x/p.aspect_ratio,self.pattern_y,height,
                     p.thickness,p.smoothing)
 
+    def _support(self,p):
+        radius = p.size/2.0+p.thickness/2.0+gaussian_extent(p.smoothing,p.support_tolerance)
+        return (p.aspect_ratio*radius,radius)
+
 
 class OrientationContrast(SineGrating):
     """
@@ -279,11 +364,11 @@ class OrientationContrast(SineGrating):
                             orientation=surround_or, scale=p.scalesurround, offset=p.offsetsurround,
                             x=p.x, y=p.y, size=p.sizesurround)
 
-        patterns = [input_1(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds),
-                    input_2(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds)]
+        patterns = [input_1(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,dtype=p.dtype),
+                    input_2(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,dtype=p.dtype)]
 
         image_array = numpy.add.reduce(patterns)
-        return image_array
+        return as_float_dtype(image_array,p.dtype)
 
 
 
@@ -293,6 +378,8 @@ class RawRectangle(PatternGenerator):
     patterns pixel by pixel.
     """
 
+    _batch_vectorized = True
+
     aspect_ratio   = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,2.0),
         precedence=0.31,doc=
         "Ratio of width to height; size*aspect_ratio gives the width of the rectangle.")
@@ -305,11 +392,16 @@ class RawRectangle(PatternGenerator):
         return bitwise_and(abs(self.pattern_x)<=width/2.0,
                            abs(self.pattern_y)<=height/2.0)
 
+    def _support(self,p):
+        return (p.aspect_ratio*p.size/2.0,p.size/2.0)
+
 
 
 class Rectangle(PatternGenerator):
     """2D rectangle pattern, with Gaussian smoothing around the edges."""
 
+    _batch_vectorized = True
+
     aspect_ratio = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,6.0),
         precedence=0.31,doc=
         "Ratio of width to height; size*aspect_ratio gives the width of the rectangle.")
@@ -326,6 +418,16 @@ class Rectangle(PatternGenerator):
         return smooth_rectangle(self.pattern_x, self.pattern_y,
                                 width, height, p.smoothing, p.smoothing)
 
+    def _support(self,p):
+        falloff = gaussian_extent(p.smoothing,p.support_tolerance)
+        return (p.aspect_ratio*p.size/2.0+falloff,p.size/2.0+falloff)
+
+    def _separable(self,p,x,y):
+        height=p.size
+        width=p.aspect_ratio*height
+        return (smooth_edge(x,width,p.smoothing),smooth_edge(y,height,p.smoothing),
+                numpy.minimum)
+
 
 
 class Arc(PatternGenerator):
@@ -340,6 +442,8 @@ class Arc(PatternGenerator):
     See the Disk class for a note about the Gaussian fall-off.
     """
 
+    _batch_vectorized = True
+
     aspect_ratio = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,6.0),
         precedence=0.31,doc="""
         Ratio of width to height; size*aspect_ratio gives the overall width.""")
@@ -363,6 +467,11 @@ class Arc(PatternGenerator):
         return arc_by_radian(self.pattern_x/p.aspect_ratio, self.pattern_y, p.size,
                              (2*pi-p.arc_length, 0.0), p.thickness, p.smoothing)
 
+    def _support(self,p):
+        # Bounded by the full ring
+        radius = p.size/2.0+p.thickness/2.0+gaussian_extent(p.smoothing,p.support_tolerance)
+        return (p.aspect_ratio*radius,radius)
+
 
 class Curve(Arc):
     """
@@ -415,6 +524,11 @@ class Curve(Arc):
                              (p.size_type=='constant_length'),
                              p.thickness, p.smoothing)
 
+    def _support(self,p):
+        # CEBALERT: the curve's ring is not centered on the pattern's
+        # center, so Arc's region of support does not apply.
+        return None
+
 
 
 #JABALERT: Can't this be replaced with a Composite?
@@ -454,10 +568,18 @@ class TwoRectangles(Rectangle):
                         (self.pattern_y-p.y2)<=p.y2+height/4.0,
                         (self.pattern_y-p.y2)>=p.y2-height/4.0)))
 
+    def _support(self,p):
+        return None
+
+    def _separable(self,p,x,y):
+        return None
+
 
 class SquareGrating(PatternGenerator):
     """2D squarewave grating pattern generator."""
 
+    _batch_vectorized = True
+
     frequency = param.Number(default=2.4,bounds=(0.0,None),softbounds=(0.0,10.0),
         precedence=0.50,doc="Frequency of the square grating.")
 
@@ -503,22 +625,32 @@ class Sweeper(PatternGenerator):
         Number of steps at the given speed to move in the sweep direction.
         The distance moved is speed*step.""")
 
+    memo = param.ClassSelector(default=None,class_=PatternMemo,allow_None=True,
+        precedence=-1,doc="""
+        Optional PatternMemo from which to copy patterns of the
+        generator already drawn with the same parameter values,
+        rather than drawing them again.""")
+
+    _function_out = True
+    _function_uses_grids = False
+
     # Provide access to value needed for measuring maps
     def __get_phase(self): return self.generator.phase
     def __set_phase(self,new_val): self.generator.phase = new_val
     phase = property(__get_phase,__set_phase)
 
-    def function(self,p):
+    def function(self,p,out=None):
         """Selects and returns one of the patterns in the list."""
         pg = p.generator
         motion_orientation=p.orientation+pi/2.0
 
         new_x = p.x+p.size*pg.x
         new_y = p.y+p.size*pg.y
+        x,y = Transform(new_x,new_y,motion_orientation)(p.speed*p.step,0.0)
 
-        image_array = pg(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,
-                         x=new_x + p.speed*p.step*cos(motion_orientation),
-                         y=new_y + p.speed*p.step*sin(motion_orientation),
+        draw = pg._call_into if p.memo is None else partial(p.memo.draw,pg)
+        image_array = draw(out,xdensity=p.xdensity,ydensity=p.ydensity,
+                         bounds=p.bounds,dtype=p.dtype,x=x,y=y,
                          orientation=p.orientation,
                          scale=pg.scale*p.scale,offset=pg.offset+p.offset)
 
@@ -577,6 +709,31 @@ class Composite(PatternGenerator):
 
     size  = param.Number(default=1.0,doc="Scaling factor applied to all sub-patterns.")
 
+    parallel = param.ObjectSelector(default=None,objects=[None,'threads'],
+        precedence=-1,doc="""
+        If 'threads', the generators' patterns are drawn concurrently
+        by a persistent pool of worker threads (see workers), and then
+        combined in order, giving the same result as drawing them one
+        at a time.  Generators that share a random number stream that
+        is not time_dependent may get its values in a different order;
+        random patterns that depend only on time_fn are unaffected.
+
+        A generator that appears more than once in generators is only
+        drawn by one thread at a time, but generators that contain the
+        same generator (e.g. two Composites sharing one) should not be
+        drawn with threads.
+
+        (Worker processes are not offered here, because starting them
+        for each pattern costs more than drawing a few generators; see
+        Animation's processes parameter instead.)""")
+
+    workers = param.Integer(default=None,allow_None=True,bounds=(1,None),precedence=-1,doc="""
+        Number of worker threads used when parallel is not None;
+        defaults to the number of CPUs.""")
+
+    _function_out = True
+    _function_uses_grids = False
+
 
     def _advance_pattern_generators(self,p):
         """
@@ -602,27 +759,154 @@ class Composite(PatternGenerator):
         for gen in self.generators:
             gen.state_pop()
 
-    # JABALERT: To support large numbers of patterns on a large input region,
-    # should be changed to evaluate each pattern in a small box, and then
-    # combine them at the full Composite Bounding box size.
-    def function(self,p):
-        """Constructs combined pattern out of the individual ones."""
+    def function(self,p,out=None):
+        """
+        Constructs combined pattern out of the individual ones.
+
+        For binary ufunc operators, the patterns are combined one at a
+        time into a single array, as reduce would, rather than all
+        being kept until the end.  Where a pattern is known to be zero
+        outside some part of the array (see support_tolerance), and
+        combining with zero leaves values unchanged, only that part is
+        combined.
+        """
         generators = self._advance_pattern_generators(p)
+        transform = Transform.of(p)
 
         assert hasattr(p.operator,'reduce'),repr(p.operator)+" does not support 'reduce'."
 
+        if p.parallel is not None and len(generators)>1:
+            params = [self._generator_params(p,pg,transform) for pg in generators]
+            x_points,y_points = self._coordinate_vectors(p.bounds,p.xdensity,p.ydensity)
+            # A generator appearing more than once is drawn by one
+            # worker at a time
+            groups = {}
+            for i,pg in enumerate(generators):
+                groups.setdefault(id(pg),[]).append(i)
+            patterns = _draw_concurrently(lambda i,pattern: generators[i]._call_into(pattern,**params[i]),
+                                          len(generators),(len(y_points),len(x_points)),p.dtype,
+                                          p.workers,groups=sorted(groups.values()))
+            image_array = p.operator.reduce(patterns)
+            if out is not None:
+                out[...] = image_array
+                return out
+            return image_array
+
+        if not (isinstance(p.operator,numpy.ufunc) and p.operator.nin==2 and
+                len(generators)>(0 if out is not None else 1)):
+            patterns = [pg(**self._generator_params(p,pg,transform)) for pg in generators]
+            image_array = p.operator.reduce(patterns)
+            if out is not None:
+                out[...] = image_array
+                return out
+            return image_array
+
+        if out is None:
+            # The first combination allocates the result, with the
+            # same type as reduce would give.
+            first = generators[0](**self._generator_params(p,generators[0],transform))
+            pattern = self._draw_generator(p,generators[1],first,transform)
+            out = p.operator(first,pattern)
+            generators = generators[2:]
+        else:
+            generators[0]._call_into(out,**self._generator_params(p,generators[0],transform))
+            generators = generators[1:]
+
+        identity_checked = None
+        for pg in generators:
+            pattern = self._draw_generator(p,pg,out,transform)
+            zero_outside = pg._zero_outside if _uses_base_call(pg) else None
+            if zero_outside is not None and identity_checked is None:
+                identity_checked = _zero_is_identity(p.operator,out)
+            if zero_outside is not None and identity_checked:
+                region = zero_outside.submatrix(out)
+                p.operator(region,zero_outside.submatrix(pattern),region)
+            else:
+                p.operator(out,pattern,out)
+        return out
+
+
+    def _draw_generator(self,p,pg,like,transform=None):
+        """
+        Draw the pattern of generator pg into a scratch array shaped
+        like the array like, and return it.
+        """
+        pattern = self._scratch('pattern',like,p.dtype)
+        pg._call_into(pattern,**self._generator_params(p,pg,transform))
+        return pattern
+
+
+    def _generator_params(self,p,pg,transform=None):
+        """
+        Return the parameter overrides with which to draw the
+        generator pg as part of this pattern, whose placement is
+        given by transform (Transform.of(p) if not supplied).
+        """
         # CEBALERT: mask gets applied by all PGs including the Composite itself
         # (leads to redundant calculations in current lissom_oo_or usage, but
         # will lead to problems/limitations in the future).
-        patterns = [pg(xdensity=p.xdensity,ydensity=p.ydensity,
-                       bounds=p.bounds,mask=p.mask,
-                       x=p.x+p.size*(pg.x*cos(p.orientation)- pg.y*sin(p.orientation)),
-                       y=p.y+p.size*(pg.x*sin(p.orientation)+ pg.y*cos(p.orientation)),
-                       orientation=pg.orientation+p.orientation,
-                       size=pg.size*p.size)
-                    for pg in generators]
-        image_array = p.operator.reduce(patterns)
-        return image_array
+        if transform is None:
+            transform = Transform.of(p)
+        params = dict(xdensity=p.xdensity,ydensity=p.ydensity,
+                      bounds=p.bounds,mask=p.mask,dtype=p.dtype,
+                      **(transform*Transform.of(pg)).params())
+        # Generators keep their own support_tolerance unless the
+        # Composite specifies one
+        if p.support_tolerance is not None:
+            params['support_tolerance'] = p.support_tolerance
+        return params
+
+
+def _zero_is_identity(operator,array):
+    """
+    Whether operator(array,0) would leave array unchanged, so that it
+    can be skipped.  For maximum and minimum, once this holds for
+    array it also holds for every array that the same operator later
+    produces from it, so it needs to be checked only once.
+    """
+    if operator in (numpy.add,numpy.subtract):
+        return True
+    if operator is numpy.maximum:
+        return bool(array.min()>=0.0)
+    if operator is numpy.minimum:
+        return bool(array.max()<=0.0)
+    return False
+
+
+
+class _CenterIndex(object):
+    """
+    Set of (x,y) points, indexed by the cells of a square grid whose
+    spacing is the minimum separation, so that any point closer than
+    that to a given point is in the same cell or one of its eight
+    neighbours.
+    """
+
+    def __init__(self, separation):
+        self.separation = separation
+        self._cells = {}
+
+
+    def _cell(self, x, y):
+        return (int(floor(x/self.separation)),int(floor(y/self.separation)))
+
+
+    def clear_of(self, x, y):
+        """Return True if (x,y) is at least the separation from all points."""
+        if not self.separation > 0:
+            return True
+        i,j = self._cell(x,y)
+        for di in (-1,0,1):
+            for dj in (-1,0,1):
+                for (px,py) in self._cells.get((i+di,j+dj),()):
+                    if sqrt((x-px)**2 + (y-py)**2) < self.separation:
+                        return False
+        return True
+
+
+    def add(self, x, y):
+        if self.separation > 0:
+            self._cells.setdefault(self._cell(x,y),[]).append((x,y))
 
 
 
@@ -660,39 +944,36 @@ class SeparatedComposite(Composite):
         met.""")
 
 
-    def __distance_valid(self, g0, g1, p):
-        """
-        Returns true if the distance between the (x,y) locations of two generators
-        g0 and g1 is greater than a minimum separation.
-
-        Can be extended easily to support other criteria.
-        """
-        dist = sqrt((g1.x - g0.x) ** 2 +
-                    (g1.y - g0.y) ** 2)
-        return dist >= p.min_separation
-
-
     def _advance_pattern_generators(self,p):
         """
         Advance the parameters for each generator for this presentation.
 
-        Picks a position for each generator that is accepted by __distance_valid
-        for all combinations.  Returns a new list of the generators, with
+        Picks a position for each generator that is at least
+        min_separation from the positions of all the generators
+        accepted before it.  Returns a new list of the generators, with
         some potentially omitted due to failure to meet the constraints.
-        """
 
+        Positions are checked against an index of the accepted
+        positions, so that each check involves only nearby positions.
+        Each generator's x and y are evaluated once, and then advanced
+        only when a new position is needed, so that the values drawn
+        for each generator do not depend on how many generators were
+        accepted before it.
+        """
+        centers = _CenterIndex(p.min_separation)
         valid_generators = []
         for g in p.generators:
+            x,y = g.x,g.y
 
             for trial in xrange(self.max_trials):
-                # Generate a new position and add generator if it's ok
-
-                if alltrue([self.__distance_valid(g,v,p) for v in valid_generators]):
+                # Add generator if its position is ok, else generate a new one
+                if centers.clear_of(x,y):
+                    centers.add(x,y)
                     valid_generators.append(g)
                     break
 
-                g.force_new_dynamic_value('x')
-                g.force_new_dynamic_value('y')
+                x = g.force_new_dynamic_value('x')
+                y = g.force_new_dynamic_value('y')
 
             else:
                 self.warning("Unable to place pattern %s subject to given constraints" %
@@ -702,6 +983,144 @@ class SeparatedComposite(Composite):
 
 
 
+class _FrameSequence(object):
+    """
+    Read-only sequence of n items, each computed by item(i) only
+    when it is accessed.
+    """
+
+    def __init__(self, n, item):
+        self._n = n
+        self._item = item
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._item(j) for j in xrange(*i.indices(self._n))]
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError("Sequence index out of range.")
+        return self._item(i)
+
+    def __iter__(self):
+        for i in xrange(self._n):
+            yield self._item(i)
+
+
+
+class _LazyFrames(object):
+    """
+    Stands in for the ordered dictionary of a lazy Animation's items,
+    mapping (time,) keys to frames that are generated only when they
+    are accessed.  At most cache_size generated frames are kept (all
+    of them if cache_size is None), so that the memory used by the
+    Animation is bounded.
+    """
+
+    def __init__(self, animation, cache_size=None):
+        self._animation = animation
+        self.cache = LRUCache(maxsize=cache_size)
+
+    def _key(self, i):
+        anim = self._animation
+        time_type = anim.time_fn.time_type
+        return (time_type(anim.offset) + i*time_type(anim.timestep),)
+
+    def _frame(self, i):
+        key = self._key(i)
+        frame = self.cache.get(key)
+        if frame is None:
+            frame = self._animation._generate_frame(key[0])
+            self.cache.put(key, frame)
+        return frame
+
+    def _index(self, key):
+        anim = self._animation
+        if not isinstance(key, tuple) or len(key) != 1:
+            return None
+        try:
+            i = int(round((key[0]-anim.offset)/float(anim.timestep)))
+        except TypeError:
+            return None
+        return i if (0 <= i < len(self) and self._key(i) == key) else None
+
+    def __getitem__(self, key):
+        i = self._index(key)
+        if i is None:
+            raise KeyError(key)
+        return self._frame(i)
+
+    def __setitem__(self, key, value):
+        raise TypeError("Frames cannot be added to an Animation with lazy=True.")
+
+    def pop(self, *args):
+        raise TypeError("Frames cannot be removed from an Animation with lazy=True.")
+
+    def __contains__(self, key):
+        return self._index(key) is not None
+
+    def __len__(self):
+        return self._animation.frames
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return _FrameSequence(len(self), self._key)
+
+    def values(self):
+        return _FrameSequence(len(self), self._frame)
+
+    def items(self):
+        return _FrameSequence(len(self), lambda i: (self._key(i), self._frame(i)))
+
+
+
+def _time_determined(obj, seen=None):
+    """
+    Return True if the values drawn from obj (e.g. a PatternGenerator)
+    are a fixed function of the time, because neither obj nor any
+    parameter value it draws from uses random numbers or other state,
+    except for time_dependent objects.
+
+    Conservatively returns False for any value generator other than
+    a time_dependent numbergen object or an expression of those.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return True
+    seen.add(id(obj))
+
+    if isinstance(obj, (list, tuple)):
+        return all(_time_determined(value, seen) for value in obj)
+    if isinstance(obj, TimeAware) and not _time_fixed(obj):
+        return False
+    if isinstance(obj, NumberGenerator):
+        if _time_fixed(obj):
+            return True
+        operands = (obj.expression,) if isinstance(obj, CompiledExpression) else \
+                   (obj.lhs, obj.rhs) if isinstance(obj, BinaryOperator) else \
+                   (obj.operand,) if isinstance(obj, UnaryOperator) else \
+                   (obj.generator,) if isinstance(obj, BoundedNumber) else None
+        return operands is not None and \
+            all(not callable(o) or (isinstance(o, NumberGenerator) and _time_determined(o, seen))
+                for o in operands)
+    if isinstance(obj, param.Parameterized):
+        for name, param_obj in obj.params().items():
+            value = obj.get_value_generator(name)
+            if isinstance(param_obj, param.Dynamic) and param_obj._value_is_dynamic(obj) \
+               and not isinstance(value, NumberGenerator):
+                return False
+            if not _time_determined(value, seen):
+                return False
+    return True
+
+
+
 class Animation(SheetStack):
     """
     An Animation is a collection of SheetLayers associated with
@@ -739,10 +1158,47 @@ class Animation(SheetStack):
        number or some continuous (e.g. floating point or rational)
        representation of time.""")
 
+    processes = param.Integer(default=None, allow_None=True, bounds=(1,None), doc="""
+       If not None, the number of worker processes among which the
+       generation of frames is divided.  Each frame is generated in
+       shared memory by a copy of the pattern, with time_fn set to the
+       frame's time.  This is done only if the pattern varies solely
+       with time_fn (e.g. through time_dependent numbergen objects),
+       because the copies would otherwise all continue from the same
+       random or other state, giving different frames than when
+       generated one at a time.
+
+       The worker processes are forked, so this requires a platform
+       with os.fork (i.e. not Windows); elsewhere, within another
+       worker process, or for patterns that do not vary solely with
+       time_fn, the frames are generated one at a time as usual.  Any parallel Composites in the pattern draw serially
+       within the worker processes.""")
+
+    lazy = param.Boolean(default=False, doc="""
+       Whether to generate each frame only when it is first accessed
+       (e.g. by indexing or iteration), rather than generating all the
+       frames when the Animation is created.  Frame i is then the one
+       for time offset+i*timestep, and is generated by the pattern
+       starting from the pattern's state at that time, so frames are
+       the same as when generated eagerly only if the pattern varies
+       solely with time_fn.  Frames cannot be added to or removed from
+       a lazy Animation.""")
+
+    cache_size = param.Integer(default=None, allow_None=True, bounds=(0,None), doc="""
+       For a lazy Animation, the maximum number of generated frames to
+       keep (the most recently used ones), or None to keep them all.
+       Setting it allows any number of frames to be iterated over in
+       constant memory.""")
+
 
     def __init__(self, initial_items=None, **kwargs):
         super(Animation, self).__init__(initial_items, **kwargs)
-        if (initial_items is None) and self.frames:
+        if (initial_items is None) and self.frames and self.lazy:
+            self._data = _LazyFrames(self, self.cache_size)
+        elif (initial_items is None) and self.frames and self.processes and _can_fork() \
+                and _time_determined(self.pattern):
+            self._generate_frames_concurrently()
+        elif (initial_items is None) and self.frames:
             self.pattern.state_push()
             with self.time_fn as t:
                 t(self.offset)
@@ -751,8 +1207,66 @@ class Animation(SheetStack):
                     t += self.timestep
             self.pattern.state_pop()
 
+    def _generate_frame(self, time):
+        self.pattern.state_push()
+        with self.time_fn as t:
+            t(time)
+            frame = self.pattern[:]
+        self.pattern.state_pop()
+        return frame
+
+
+    def _generate_frames_concurrently(self):
+        times = []
+        with self.time_fn as t:
+            t(self.offset)
+            for i in range(self.frames):
+                times.append(t())
+                t += self.timestep
+
+        def draw(i, out):
+            self.time_fn(times[i])
+            self.pattern._call_into(out)
+
+        pattern = self.pattern
+        shape = SheetCoordinateSystem(pattern.bounds, pattern.xdensity, pattern.ydensity).shape
+        frames = _draw_concurrently(draw, self.frames, shape, pattern.dtype,
+                                    self.processes, processes=True)
+        for time, frame in zip(times, frames):
+            self[time] = pattern._sheetview(frame)
+
+
+    def __getitem__(self, indexslice):
+        if not isinstance(self._data, _LazyFrames) or indexslice in [Ellipsis, ()]:
+            return super(Animation,self).__getitem__(indexslice)
+
+        map_slice, data_slice = self._split_index(indexslice)
+        map_slice = self._transform_indices(map_slice)
+        if all(not isinstance(el, slice) for el in map_slice):
+            return super(Animation,self).__getitem__(indexslice)
+
+        # Filter on the keys first, so that only the selected frames
+        # are generated
+        conditions = self._generate_conditions(map_slice)
+        items = [(k[0], self._dataslice(self._data[k], data_slice))
+                 for k in self._data.keys() if self._conjunction(k, conditions)]
+        return self.clone(items)
+
+
+    def items(self):
+        if not isinstance(self._data, _LazyFrames):
+            return super(Animation,self).items()
+        keys, values = self.keys(), self.values()
+        return _FrameSequence(len(keys), lambda i: (keys[i], values[i]))
+
+
     def map(self, map_fn, **kwargs):
-        return super(Animation,self).map(map_fn, **dict(kwargs, frames=None))
+        return super(Animation,self).map(map_fn, **dict(kwargs, frames=None, processes=None))
+
+    def _resort(self):
+        # Lazy frames are always in order
+        if not isinstance(self._data, _LazyFrames):
+            super(Animation,self)._resort()
 
     def _item_check(self, dim_vals, data):
         if (dim_vals[0] % self.time_fn.time_type(self.timestep)) != self.time_fn.time_type(self.offset):
@@ -797,17 +1311,27 @@ class Selector(PatternGenerator):
         random value or other number generator, to allow a different item
         to be selected each time.""")
 
+    memo = param.ClassSelector(default=None,class_=PatternMemo,allow_None=True,
+        precedence=-1,doc="""
+        Optional PatternMemo from which to copy patterns of the
+        generators already drawn with the same parameter values,
+        rather than drawing them again.""")
 
-    def function(self,p):
+    _function_out = True
+    _function_uses_grids = False
+
+
+    def function(self,p,out=None):
         """Selects and returns one of the patterns in the list."""
         int_index=int(len(p.generators)*wrap(0,1.0,p.index))
         pg=p.generators[int_index]
 
-        image_array = pg(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,
-                         x=p.x+p.size*(pg.x*cos(p.orientation)-pg.y*sin(p.orientation)),
-                         y=p.y+p.size*(pg.x*sin(p.orientation)+pg.y*cos(p.orientation)),
-                         orientation=pg.orientation+p.orientation,size=pg.size*p.size,
-                         scale=pg.scale*p.scale,offset=pg.offset+p.offset)
+        transform = Transform.of(p)*Transform.of(pg)
+        draw = pg._call_into if p.memo is None else partial(p.memo.draw,pg)
+        image_array = draw(out,xdensity=p.xdensity,ydensity=p.ydensity,
+                         bounds=p.bounds,dtype=p.dtype,
+                         scale=pg.scale*p.scale,offset=pg.offset+p.offset,
+                         **transform.params())
 
         return image_array
 
@@ -854,12 +1378,12 @@ class GaussiansCorner(PatternGenerator):
         g_2 = Gaussian()
 
         x_1 = g_1(orientation = p.orientation, bounds = p.bounds, xdensity = p.xdensity,
-                            ydensity = p.ydensity, offset = p.offset, size = p.size,
+                            ydensity = p.ydensity, dtype = p.dtype, offset = p.offset, size = p.size,
                             aspect_ratio = p.aspect_ratio,
                             x = p.x + 0.7 * cos(p.orientation) * p.cross * p.size * p.aspect_ratio,
                             y = p.y + 0.7 * sin(p.orientation) * p.cross * p.size * p.aspect_ratio)
         x_2 = g_2(orientation = p.orientation+p.angle, bounds = p.bounds, xdensity = p.xdensity,
-                            ydensity = p.ydensity, offset = p.offset, size = p.size,
+                            ydensity = p.ydensity, dtype = p.dtype, offset = p.offset, size = p.size,
                             aspect_ratio = p.aspect_ratio,
                             x = p.x + 0.7 * cos(p.orientation+p.angle) * p.cross * p.size * p.aspect_ratio,
                             y = p.y + 0.7 * sin(p.orientation+p.angle) * p.cross * p.size * p.aspect_ratio)
@@ -915,6 +1439,24 @@ class Translator(PatternGenerator):
     time_fn = param.Callable(default=param.Dynamic.time_fn,doc="""
         Function to generate the time used as a base for translation.""")
 
+    incremental = param.ObjectSelector(default=None,objects=[None,'nearest','linear'],
+        precedence=-1,doc="""
+        If not None, the generator is drawn only once for each
+        episode, on a matrix large enough to cover the sheet
+        throughout the episode's motion, and each pattern is then
+        cut out of that matrix at the current displacement, either
+        rounded to the nearest matrix unit ('nearest') or
+        interpolated bilinearly between the nearest four ('linear').
+
+        That matrix is drawn again if the generator, or the values
+        set on its parameters, change.  Dynamic parameters of the
+        generator are not given new values within an episode, so this
+        is only suitable when they need not change.  Generators with
+        a mask or output_fns (which may depend on the whole pattern)
+        are always drawn directly.""")
+
+    _call_out = True
+
     def _advance_params(self):
         """
         Explicitly generate new values for these parameters only
@@ -928,17 +1470,20 @@ class Translator(PatternGenerator):
     def __init__(self,**params):
         super(Translator,self).__init__(**params)
         self._advance_params()
+        self._master = None
 
 
-    def __call__(self,**params_to_override):
+    def __call__(self,out=None,**params_to_override):
         p=ParamOverrides(self,params_to_override)
 
         if self.time_fn() >= self.last_time + p.reset_period:
             ## Returns early if within episode interval
             if self.time_fn()<self.last_time+p.reset_period+p.episode_interval:
-                return p.episode_separator(xdensity=p.xdensity,
-                                           ydensity=p.ydensity,
-                                           bounds=p.bounds)
+                return p.episode_separator._call_into(out,
+                                                      xdensity=p.xdensity,
+                                                      ydensity=p.ydensity,
+                                                      bounds=p.bounds,
+                                                      dtype=p.dtype)
             else:
                 self._advance_params()
 
@@ -958,18 +1503,94 @@ class Translator(PatternGenerator):
         # compute how much time elapsed from the last reset
         # float(t) required because time could be e.g. gmpy.mpq
         t = float(self.time_fn()-self.last_time)
+        moved_x,moved_y = Transform(x,y,direction)(t*p.speed,0.0)
+
+        if p.incremental is not None:
+            result = self._draw_incremental(p,out,x,y,direction,t)
+            if result is not None:
+                return result
 
         ## CEBALERT: mask gets applied twice, both for the underlying
         ## generator and for this one.  (leads to redundant
         ## calculations in current lissom_oo_or usage, but will lead
         ## to problems/limitations in the future).
-        return p.generator(
-            xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,
-            x=x+t*cos(direction)*p.speed+p.generator.x,
-            y=y+t*sin(direction)*p.speed+p.generator.y,
+        return p.generator._call_into(out,
+            xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,dtype=p.dtype,
+            x=moved_x+p.generator.x,
+            y=moved_y+p.generator.y,
             orientation=(direction-pi/2)+p.generator.orientation)
 
 
+    def _draw_incremental(self,p,out,x,y,direction,t):
+        """
+        Return the pattern for time t since the start of the episode
+        beginning at (x,y) in the given direction, cut out of the
+        episode's master pattern (drawing the master first if
+        necessary), or None if it cannot be cut out.
+        """
+        gen = p.generator
+        if gen.mask is not None or gen.output_fns:
+            return None
+
+        x_points,y_points = self._coordinate_vectors(p.bounds,p.xdensity,p.ydensity)
+        rows,cols = len(y_points),len(x_points)
+        # The generator's parameter values are inspected, so that
+        # dynamic ones are not given new values
+        gen_values = dict((name,gen.inspect_value(name)) for name in gen.params())
+        key = (self.last_time,x,y,direction,p.speed,p.reset_period,
+               tuple(p.bounds.lbrt()),p.xdensity,p.ydensity,_dtype_key(p.dtype),
+               id(gen),tuple(sorted((k,_hashable(v)) for k,v in gen_values.items())))
+
+        if self._master is None or self._master[0]!=key:
+            # Extend the sheet by the greatest displacement during the
+            # episode (in matrix units), plus one unit on each side
+            # for rounding and interpolation
+            travel_x,travel_y = Transform(orientation=direction)(p.speed*p.reset_period,0.0)
+            travel_cols,travel_rows = travel_x*p.xdensity,travel_y*p.ydensity
+            extra_cols,extra_rows = int(ceil(abs(travel_cols))),int(ceil(abs(travel_rows)))
+            left,right = (1+extra_cols,1) if travel_cols>0 else (1,1+extra_cols)
+            top,bottom = (1,1+extra_rows) if travel_rows>0 else (1+extra_rows,1)
+
+            xstep,ystep = 1.0/p.xdensity,1.0/p.ydensity
+            bounds = BoundingBox(points=((x_points[0]-(left+0.5)*xstep,y_points[-1]-(bottom+0.5)*ystep),
+                                         (x_points[-1]+(right+0.5)*xstep,y_points[0]+(top+0.5)*ystep)))
+            master = gen(bounds=bounds,xdensity=p.xdensity,ydensity=p.ydensity,dtype=p.dtype,
+                         x=x+gen.x,y=y+gen.y,orientation=(direction-pi/2)+gen.orientation)
+            if master.shape != (rows+top+bottom,cols+left+right):
+                master = None
+            # The generator and its values are kept, so that the ids
+            # in the key are not reused
+            self._master = (key,master,left,top,(gen,gen_values))
+
+        master,left,top = self._master[1:4]
+        if master is None:
+            return None
+
+        # Position of the sheet within the master, in matrix units
+        dx,dy = Transform(orientation=direction)(t*p.speed,0.0)
+        col = left-dx*p.xdensity
+        row = top+dy*p.ydensity
+
+        if p.incremental=='nearest':
+            r,c = int(round(row)),int(round(col))
+            if not (0<=r<=master.shape[0]-rows and 0<=c<=master.shape[1]-cols):
+                return None
+            result = master[r:r+rows,c:c+cols]
+        else:
+            r,c = int(floor(row)),int(floor(col))
+            if not (0<=r<master.shape[0]-rows and 0<=c<master.shape[1]-cols):
+                return None
+            fy,fx = row-r,col-c
+            window = lambda i,j: master[r+i:r+i+rows,c+j:c+j+cols]
+            result = (1-fy)*((1-fx)*window(0,0)+fx*window(0,1)) + \
+                     fy*((1-fx)*window(1,0)+fx*window(1,1))
+
+        if out is not None:
+            out[...] = result
+            return out
+        return result.copy() if result.base is not None else result
+
+
 
 class DifferenceOfGaussians(PatternGenerator):
     """
@@ -1012,7 +1633,7 @@ class DifferenceOfGaussians(PatternGenerator):
             orientation=p.orientation, output_fns=[DivisiveNormalizeL1()])
 
         return Composite(generators=[positive,negative], operator=numpy.subtract,
-            xdensity=p.xdensity, ydensity=p.ydensity, bounds=p.bounds)()
+            xdensity=p.xdensity, ydensity=p.ydensity, bounds=p.bounds, dtype=p.dtype)()
 
 
 
@@ -1022,6 +1643,8 @@ class Sigmoid(PatternGenerator):
     and negative halves with a smoothly sloping transition between them.
     """
 
+    _batch_vectorized = True
+
     slope = param.Number(default=10.0, bounds=(None,None), softbounds=(-100.0,100.0),
         doc="""Parameter controlling the smoothness of the transition
         between the two regions; high values give a sharp transition.""")
@@ -1068,7 +1691,7 @@ class SigmoidedDoG(PatternGenerator):
         sigmoid = Sigmoid(slope=p.sigmoid_slope, orientation=p.orientation+pi/2, x=p.x+p.sigmoid_position)
 
         return Composite(generators=[diff_of_gaussians, sigmoid], bounds=p.bounds,
-            operator=numpy.multiply, xdensity=p.xdensity, ydensity=p.ydensity)()
+            operator=numpy.multiply, xdensity=p.xdensity, ydensity=p.ydensity, dtype=p.dtype)()
 
 
 
@@ -1110,7 +1733,7 @@ class LogGaussian(PatternGenerator):
         self._apply_mask(p, fn_result)
 
         scale_factor = p.scale / max(fn_result)
-        result = scale_factor*fn_result + p.offset
+        result = as_float_dtype(scale_factor*fn_result + p.offset, p.dtype)
 
         for of in p.output_fns:
             of(result)
@@ -1218,12 +1841,13 @@ class SigmoidedDoLG(PatternGenerator):
             output_fns=[])
 
         diff_of_log_gaussians = Composite(generators=[positive, negative], operator=subtract,
-            xdensity=p.xdensity, ydensity=p.ydensity, bounds=p.bounds)
+            xdensity=p.xdensity, ydensity=p.ydensity, bounds=p.bounds, dtype=p.dtype)
 
         sigmoid = Sigmoid(x=p.x+p.sigmoid_position, slope=p.sigmoid_slope, orientation=p.orientation+pi/2.0)
 
         return Composite(generators=[diff_of_log_gaussians, sigmoid], bounds=p.bounds,
-            operator=multiply, xdensity=p.xdensity, ydensity=p.ydensity, output_fns=[DivisiveNormalizeL1()])()
+            operator=multiply, xdensity=p.xdensity, ydensity=p.ydensity, dtype=p.dtype,
+            output_fns=[DivisiveNormalizeL1()])()
 
 
 
@@ -4,18 +4,27 @@ PatternGenerators based on bitmap images stored in files.
 Requires the Python Imaging Library (PIL).
 """
 
+import os
+import json
+import time
+import atexit
+import weakref
+import threading
+import Queue
+
 import Image
 import ImageOps
 
 import numpy
 from numpy.oldnumeric import array, Float, sum, ravel, ones
+from numpy.lib.format import open_memmap
 
 import param
 from param.parameterized import overridable_property
 
 from dataviews.boundingregion import BoundingBox
 from dataviews.sheetcoords import SheetCoordinateSystem
-from patterngenerator import PatternGenerator
+from patterngenerator import PatternGenerator, LRUCache, as_float_dtype
 from transferfn import DivisiveNormalizeLinf, TransferFn
 
 
@@ -87,13 +96,48 @@ class PatternSampler(ImageSampler):
         corresponds to one matrix unit of the Sheet on which the
         pattern being displayed.""")
 
+    interpolation = param.ObjectSelector(default='nearest',
+        objects=['nearest','bilinear','bicubic'],doc="""
+        How the image is resampled at each location: 'nearest' takes
+        the pixel the location falls in, while 'bilinear' and
+        'bicubic' interpolate between the nearest 2x2 or 4x4 pixel
+        centers (repeating the edge pixels of the image as
+        necessary).""")
+
+    pyramid = param.Boolean(default=False,doc="""
+        Whether to sample from a reduced-resolution copy of the image
+        when the image is drawn at a lower resolution than its own.
+
+        If True, a pyramid of copies of the image is built (as needed)
+        by repeatedly averaging 2x2 blocks of pixels, and each pattern
+        is sampled from the smallest copy that still has at least one
+        pixel per sample.  This avoids the aliasing that results from
+        sampling a large image at widely spaced points, and touches
+        much less memory.  The copies are kept along with the image,
+        if the image is read-only (see _prepare).""")
+
+    def __init__(self,**params):
+        super(PatternSampler,self).__init__(**params)
+        self._prepared = LRUCache(maxsize=4)
+
+
+    def __getstate__(self):
+        # Prepared images are not worth pickling
+        state = super(PatternSampler,self).__getstate__()
+        state['_prepared'] = LRUCache(maxsize=self._prepared.maxsize)
+        return state
+
+
     def _get_image(self):
         return self.scs.activity
 
     def _set_image(self,image):
         # Stores a SheetCoordinateSystem with an activity matrix
-        # representing the image
-        if not isinstance(image,numpy.ndarray):
+        # representing the image.  The whole_pattern_output_fns
+        # modify the image in place, so read-only (e.g. shared or
+        # memory-mapped) arrays are copied if there are any.
+        if not isinstance(image,numpy.ndarray) or \
+                (self.whole_pattern_output_fns and not image.flags.writeable):
             image = array(image,Float)
 
         rows,cols = image.shape
@@ -103,7 +147,11 @@ class PatternSampler(ImageSampler):
         self.scs.activity=image
 
     def _del_image(self):
+        # Prepared images (which keep the arrays they were made from)
+        # are discarded too, so that the memory can be freed
         self.scs = None
+        self._levels = []
+        self._prepared.clear()
 
 
     def __call__(self, image, x, y, sheet_xdensity, sheet_ydensity, width=1.0, height=1.0):
@@ -121,23 +169,16 @@ class PatternSampler(ImageSampler):
         size_normalization parameter, and any supplied width and
         height. sheet_xdensity and sheet_ydensity are the xdensity and
         ydensity of the sheet on which the pattern is to be drawn.
-        """
-        # CEB: could allow image=None in args and have 'if image is
-        # not None: self.image=image' here to avoid re-initializing the
-        # image.
-        self.image=image
 
-        for wpof in self.whole_pattern_output_fns:
-            wpof(self.image)
-        if not self.background_value_fn:
-            self.background_value = 0.0
-        else:
-            self.background_value = self.background_value_fn(self.image)
+        The result has the floating-point type of the supplied x and y
+        coordinates.
+        """
+        self._prepare(image)
 
         pattern_rows,pattern_cols = self.image.shape
 
         if width==0 or height==0 or pattern_cols==0 or pattern_rows==0:
-            return ones(x.shape, Float)*self.background_value
+            return ones(x.shape, x.dtype)*self.background_value
 
         # scale the supplied coordinates to match the pattern being at density=1
         x=x*sheet_xdensity # deliberately don't operate in place (so as not to change supplied x & y)
@@ -150,15 +191,101 @@ class PatternSampler(ImageSampler):
         x/=width
         y/=height
 
-        # now sample pattern at the (r,c) corresponding to the supplied (x,y)
-        r,c = self.scs.sheet2matrixidx(x,y)
-        # (where(cond,x,y) evaluates x whether cond is True or False)
-        r.clip(0,pattern_rows-1,out=r)
-        c.clip(0,pattern_cols-1,out=c)
         left,bottom,right,top = self.scs.bounds.lbrt()
-        return numpy.where((x>=left) & (x<right) & (y>bottom) & (y<=top),
-                           self.image[r,c],
-                           self.background_value)
+        level = self._pyramid_level(x,y) if self.pyramid else 0
+        if level==0 and self.interpolation=='nearest':
+            # now sample pattern at the (r,c) corresponding to the supplied (x,y)
+            r,c = self.scs.sheet2matrixidx(x,y)
+            # (where(cond,x,y) evaluates x whether cond is True or False)
+            r.clip(0,pattern_rows-1,out=r)
+            c.clip(0,pattern_cols-1,out=c)
+            values = self.image[r,c]
+        else:
+            # Each level covers the image from its top left corner,
+            # with pixels 2**level times the size of the original's
+            image = self._levels[level-1] if level>0 else self.image
+            scale = 2.0**level
+            row,col = (top-y)/scale,(x-left)/scale
+            if self.interpolation=='nearest':
+                r = numpy.floor(row).astype(int).clip(0,image.shape[0]-1)
+                c = numpy.floor(col).astype(int).clip(0,image.shape[1]-1)
+                values = image[r,c]
+            else:
+                # Continuous matrix coordinates, relative to pixel centers
+                values = _interpolate(image,row-0.5,col-0.5,self.interpolation)
+
+        return as_float_dtype(numpy.where((x>=left) & (x<right) & (y>bottom) & (y<=top),
+                                          values,
+                                          self.background_value),
+                              x.dtype)
+
+
+    def _prepare(self,image):
+        """
+        Set image as the image to sample, applying the
+        whole_pattern_output_fns and computing the background value.
+
+        For a read-only array (whose contents cannot change), the
+        result is kept, and reused whenever the same array (or an
+        equivalent view of the same memory) is supplied again with
+        the same whole_pattern_output_fns and background_value_fn.
+        Note that changes to the parameters of those functions are not
+        detected.
+        """
+        identity = _array_identity(image)
+        if identity is not None:
+            key = identity[1:]+(tuple(id(f) for f in self.whole_pattern_output_fns),
+                                id(self.background_value_fn))
+            prepared = self._prepared.get(key)
+            if prepared is not None:
+                self.scs,self.background_value,self._levels = prepared[1:]
+                return
+
+        self.image=image
+
+        for wpof in self.whole_pattern_output_fns:
+            wpof(self.image)
+        if not self.background_value_fn:
+            self.background_value = 0.0
+        else:
+            self.background_value = self.background_value_fn(self.image)
+
+        # Reduced copies of the image, built by _pyramid_level as needed
+        self._levels = []
+
+        # The array the key refers to is kept, so that its id is not reused
+        if identity is not None:
+            self._prepared.put(key,(identity[0],self.scs,self.background_value,self._levels))
+
+
+    def _pyramid_level(self,x,y):
+        """
+        Return the level of the image pyramid to sample at the given
+        image coordinates (i.e. at density 1), building it if
+        necessary.
+
+        The spacing of the samples is measured between neighbouring
+        elements of x and y (which are assumed to form a regular,
+        possibly rotated, grid), and the level chosen is the highest
+        one whose pixels are no larger than that spacing.
+        """
+        spacing = 0.0
+        if x.ndim!=2:
+            return 0
+        if x.shape[1]>1:
+            spacing = max(spacing,numpy.hypot(x[0,1]-x[0,0],y[0,1]-y[0,0]))
+        if x.shape[0]>1:
+            spacing = max(spacing,numpy.hypot(x[1,0]-x[0,0],y[1,0]-y[0,0]))
+        if not spacing>=2.0:
+            return 0
+
+        level = int(numpy.log2(spacing))
+        while len(self._levels)<level:
+            image = self._levels[-1] if self._levels else self.image
+            if min(image.shape)<2:
+                break
+            self._levels.append(_downsample(image))
+        return min(level,len(self._levels))
 
 
     def __apply_size_normalization(self,x,y,sheet_xdensity,sheet_ydensity,size_normalization):
@@ -190,6 +317,456 @@ class PatternSampler(ImageSampler):
 
 
 
+# Decoded images, shared by all FileImages.  Images from large
+# databases are typically presented many times each, and decoding and
+# converting them to grayscale takes far longer than sampling them.
+image_cache = LRUCache(maxsize=None, maxbytes=2**28)
+
+
+def load_image(filename):
+    """
+    Return the image in the given file, converted to grayscale, as a
+    read-only array of floats (from image_cache, if the file has not
+    changed since it was stored there).
+    """
+    key = (filename,os.path.getmtime(filename))
+    image = image_cache.get(key)
+    if image is None:
+        image = _decode_image(filename)
+        image.flags.writeable = False
+        image_cache.put(key,image)
+    return image
+
+
+def _decode_image(filename):
+    """
+    Return the image in the given file as an array: a Numpy (.npy)
+    file as it is, and any other file (read by PIL) converted to
+    grayscale, as floats.
+    """
+    if filename.endswith('.npy'):
+        return numpy.load(filename)
+    return array(ImageOps.grayscale(Image.open(filename)),Float)
+
+
+def _image_shape(filename):
+    """Return the shape of the array _decode_image would return, without decoding it."""
+    if filename.endswith('.npy'):
+        return numpy.load(filename,mmap_mode='r').shape
+    cols,rows = Image.open(filename).size
+    return (rows,cols)
+
+
+
+class ImageStore(param.Parameterized):
+    """
+    Collection of images stored as arrays in a single memory-mapped
+    Numpy file, so that they can be sampled without reading the files
+    they came from, decoding them, or even reading the whole store.
+
+    A store is created from image files (as read by FileImage or
+    NumpyFile) by ImageStore.create(), and then supplies the image
+    from each file by the file's absolute path (see the image_store
+    parameter of GenericImage).  The images are stored one after
+    another in path+'.npy', and their offsets and shapes are listed
+    by filename in path+'.json'.
+    """
+
+    path = param.String(default=None,allow_None=True,doc="""
+        Path of the store, without the .npy or .json extension.""")
+
+    def __init__(self,**params):
+        super(ImageStore,self).__init__(**params)
+        self._data = None
+
+
+    @classmethod
+    def create(cls,path,filenames,dtype=numpy.float32,**params):
+        """
+        Create a store at path containing the images from the given
+        files (or all the files in the given directory), converted to
+        dtype, and return an ImageStore for it.
+        """
+        if isinstance(filenames,basestring):
+            filenames = [os.path.join(filenames,f) for f in sorted(os.listdir(filenames))]
+
+        # The shapes are read first, so that the store can be
+        # allocated and then filled with one image at a time
+        index = {}
+        offset = 0
+        for filename in filenames:
+            filename = os.path.abspath(filename)
+            try:
+                rows,cols = _image_shape(filename)
+            except (IOError,ValueError):
+                param.Parameterized(name=cls.__name__).warning("Skipping %s, which is not a readable image."%filename)
+                continue
+            index[filename] = (offset,rows,cols)
+            offset += rows*cols
+
+        data = open_memmap(path+'.npy',mode='w+',dtype=dtype,shape=(offset,))
+        for filename,(offset,rows,cols) in index.items():
+            data[offset:offset+rows*cols] = _decode_image(filename).ravel()
+        data.flush()
+        del data
+
+        with open(path+'.json','w') as f:
+            json.dump(index,f)
+
+        return cls(path=path,**params)
+
+
+    def _open(self):
+        if self._data is None:
+            with open(self.path+'.json') as f:
+                self._index = json.load(f)
+            self._data = numpy.load(self.path+'.npy',mmap_mode='r')
+
+
+    def __contains__(self,filename):
+        self._open()
+        return os.path.abspath(filename) in self._index
+
+
+    def __getitem__(self,filename):
+        """Return the image from the given file, as a read-only array."""
+        self._open()
+        offset,rows,cols = self._index[os.path.abspath(filename)]
+        return self._data[offset:offset+rows*cols].reshape((rows,cols))
+
+
+    def filenames(self):
+        """Return the list of the files whose images are in the store."""
+        self._open()
+        return sorted(self._index)
+
+
+    def __getstate__(self):
+        # The memory map is opened again when needed
+        state = super(ImageStore,self).__getstate__()
+        state['_data'] = None
+        state.pop('_index',None)
+        return state
+
+
+class ImagePrefetcher(param.Parameterized):
+    """
+    Loads images from a sequence of files in background threads, ahead
+    of their being requested, so that reading and decoding the files
+    overlaps with drawing the patterns.
+
+    When the image from one of the filenames is requested by load()
+    (e.g. by a FileImage whose prefetcher this is), the images from
+    the next lookahead filenames after it are queued to be loaded by
+    a pool of worker threads.  Images are then supplied (and added to
+    image_cache) as load_image() would supply them.
+
+    The number of requests for images that had already been loaded
+    (hits), that were still being loaded (stalls; the time spent
+    waiting for them is also recorded), and that had not been
+    predicted (misses) are reported by info(), to show how much of
+    the loading is hidden.
+    """
+
+    filenames = param.List(default=[],doc="""
+        The files from which images will be requested, in the order in
+        which they are expected to be requested (wrapping around from
+        the last to the first).""")
+
+    lookahead = param.Integer(default=4,bounds=(1,None),doc="""
+        Number of images (following each one requested) to load in
+        advance; also the maximum number of images waiting to be
+        loaded.""")
+
+    threads = param.Integer(default=2,bounds=(1,None),doc="""
+        Number of worker threads loading images.""")
+
+    def __init__(self,**params):
+        super(ImagePrefetcher,self).__init__(**params)
+        self._reset()
+
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._workers = []
+        self._stopper = None
+        self._positions = None
+        # filename -> [event, (filename,mtime) key or None, image or None]
+        self._pending = {}
+        self.hits = self.misses = self.stalls = 0
+        self.stall_time = 0.0
+
+
+    def load(self,filename):
+        """
+        Return the image in the given file, as load_image() does, and
+        start loading the images from the files expected to be
+        requested next.
+        """
+        filename = os.path.abspath(filename)
+        with self._lock:
+            entry = self._pending.pop(filename,None)
+
+        image = None
+        if entry is not None:
+            event = entry[0]
+            stalled = not event.is_set()
+            if stalled:
+                start = time.time()
+                event.wait()
+                self.stall_time += time.time()-start
+                self.stalls += 1
+            key,image = entry[1:]
+            # Discard images of files changed since they were loaded
+            # (or that could not be loaded)
+            if image is not None and key==(filename,os.path.getmtime(filename)):
+                image_cache.put(key,image)
+                if not stalled:
+                    self.hits += 1
+            else:
+                image = None
+                if not stalled:
+                    self.misses += 1
+        elif (filename,os.path.getmtime(filename)) in image_cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        self._prefetch(filename)
+        return image if image is not None else load_image(filename)
+
+
+    def _prefetch(self,filename):
+        """Queue the files expected after filename to be loaded."""
+        # (Rebuilt only when the filenames change, including in place)
+        if self._positions is None or self._positions[0] != self.filenames:
+            self._positions = (list(self.filenames),
+                               dict((os.path.abspath(f),i) for i,f in enumerate(self.filenames)))
+        position = self._positions[1].get(filename)
+        if position is None:
+            return
+
+        n = len(self.filenames)
+        upcoming = [os.path.abspath(self.filenames[(position+i)%n])
+                    for i in range(1,min(self.lookahead,n-1)+1)]
+
+        if self._queue is None:
+            # The workers hold no reference to this prefetcher, so
+            # that it can be garbage collected (which stops them)
+            self._queue = queue = Queue.Queue()
+            for i in range(self.threads):
+                worker = threading.Thread(target=_prefetch_images,args=(queue,),
+                                          name="%s-%d"%(self.name,i))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+            n = len(self._workers)
+            self._stopper = weakref.ref(self,lambda ref: _stop_prefetching(queue,n))
+            _running_prefetchers.add(self)
+
+        with self._lock:
+            # Images no longer expected are dropped once loaded
+            for f,entry in self._pending.items():
+                if f not in upcoming and entry[0].is_set():
+                    del self._pending[f]
+            for f in upcoming:
+                if f in self._pending:
+                    continue
+                try:
+                    if (f,os.path.getmtime(f)) in image_cache:
+                        continue
+                except OSError:
+                    continue
+                if self._queue.qsize()>=self.lookahead:
+                    break
+                entry = [threading.Event(),None,None]
+                self._pending[f] = entry
+                self._queue.put((f,entry))
+
+
+    def stop(self):
+        """
+        Abandon the images waiting to be loaded, and stop the worker
+        threads (which are started again if needed).
+        """
+        if self._queue is None:
+            return
+        with self._lock:
+            # (load() may already have taken an abandoned file's entry,
+            # and queued the file again with a new one)
+            for filename,entry in _stop_prefetching(self._queue,len(self._workers)):
+                if self._pending.get(filename) is entry:
+                    del self._pending[filename]
+        for worker in self._workers:
+            worker.join()
+        self._queue = None
+        self._workers = []
+        self._stopper = None
+        _running_prefetchers.discard(self)
+
+
+    def info(self):
+        """
+        Return a dictionary of the numbers of hits, misses, and
+        stalls, the total time spent stalled, and the number of images
+        loaded or being loaded in advance.
+        """
+        with self._lock:
+            pending = len(self._pending)
+        return dict(hits=self.hits,misses=self.misses,stalls=self.stalls,
+                    stall_time=self.stall_time,pending=pending)
+
+
+    def __getstate__(self):
+        # The worker threads are started again when needed
+        state = super(ImagePrefetcher,self).__getstate__()
+        for k in ('_lock','_queue','_workers','_stopper','_positions','_pending'):
+            state.pop(k,None)
+        return state
+
+
+    def __setstate__(self,state):
+        super(ImagePrefetcher,self).__setstate__(state)
+        hits,misses,stalls,stall_time = self.hits,self.misses,self.stalls,self.stall_time
+        self._reset()
+        self.hits,self.misses,self.stalls,self.stall_time = hits,misses,stalls,stall_time
+
+
+def _prefetch_images(queue):
+    """
+    Load the images from the files taken from queue (with the entries
+    of ImagePrefetcher._pending to store them in) until None is taken.
+    """
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        filename,entry = item
+        try:
+            key = (filename,os.path.getmtime(filename))
+            image = _decode_image(filename)
+            image.flags.writeable = False
+            entry[1:] = key,image
+        except Exception:
+            # Left for load_image() to report, if it is requested
+            pass
+        finally:
+            entry[0].set()
+
+
+def _stop_prefetching(queue,workers):
+    """
+    Abandon the files waiting in queue, returning a list of their
+    names and entries, and tell the given number of workers taking
+    from it to stop.
+    """
+    abandoned = []
+    try:
+        while True:
+            filename,entry = queue.get_nowait()
+            entry[0].set()
+            abandoned.append((filename,entry))
+    except Queue.Empty:
+        pass
+    for i in range(workers):
+        queue.put(None)
+    return abandoned
+
+
+# ImagePrefetchers with worker threads, stopped at exit
+_running_prefetchers = weakref.WeakSet()
+
+@atexit.register
+def _stop_prefetchers():
+    for prefetcher in list(_running_prefetchers):
+        prefetcher.stop()
+
+
+
+def _array_identity(image):
+    """
+    For a read-only array whose memory cannot be modified through any
+    other array either, return a tuple of the array owning the memory
+    followed by values identifying the contents of image; otherwise
+    return None.
+    """
+    if not isinstance(image,numpy.ndarray) or image.flags.writeable:
+        return None
+    root = image
+    while isinstance(root.base,numpy.ndarray):
+        root = root.base
+    if root.flags.writeable:
+        return None
+    return (root,id(root),image.__array_interface__['data'][0],
+            image.shape,image.strides,image.dtype.str)
+
+
+def _downsample(image):
+    """
+    Return an image half the size of the given one (rounding up), each
+    pixel the average of a 2x2 block of pixels.  The last row or
+    column of an image with an odd number of them is repeated to
+    complete the blocks along that edge.
+    """
+    rows,cols = image.shape
+    if rows%2:
+        image = numpy.concatenate((image,image[-1:]),axis=0)
+    if cols%2:
+        image = numpy.concatenate((image,image[:,-1:]),axis=1)
+    return 0.25*(image[0::2,0::2]+image[1::2,0::2]+image[0::2,1::2]+image[1::2,1::2])
+
+
+def _cubic_weights(t):
+    """
+    Return the weights of the four samples at offsets -1, 0, 1, and 2
+    for interpolating at fractional positions t in [0,1), using the
+    cubic convolution kernel with a=-0.5 (Keys, 1981).
+    """
+    t2 = t*t
+    t3 = t2*t
+    return (-0.5*t3 + t2 - 0.5*t,
+            1.5*t3 - 2.5*t2 + 1.0,
+            -1.5*t3 + 2.0*t2 + 0.5*t,
+            0.5*t3 - 0.5*t2)
+
+
+def _interpolate(image,row,col,method):
+    """
+    Return the values of image interpolated at the continuous matrix
+    coordinates (row,col), where integer coordinates are pixel
+    centers, by the given method ('bilinear' or 'bicubic').  Samples
+    beyond the edges of the image take the values of the nearest edge
+    pixels.
+    """
+    rows,cols = image.shape
+    r0 = numpy.floor(row)
+    c0 = numpy.floor(col)
+    tr = row-r0
+    tc = col-c0
+    r0 = r0.astype(int)
+    c0 = c0.astype(int)
+
+    if method=='bilinear':
+        offsets = (0,1)
+        wr = (1.0-tr,tr)
+        wc = (1.0-tc,tc)
+    else:
+        offsets = (-1,0,1,2)
+        wr = _cubic_weights(tr)
+        wc = _cubic_weights(tc)
+
+    c_indices = [(c0+j).clip(0,cols-1) for j in offsets]
+    result = 0.0
+    for i,w in zip(offsets,wr):
+        r = (r0+i).clip(0,rows-1)
+        row_values = 0.0
+        for c,v in zip(c_indices,wc):
+            row_values = row_values + v*image[r,c]
+        result = result + w*row_values
+    return result
+
+
 def edge_average(a):
     "Return the mean value around the edge of an array."
 
@@ -236,7 +813,7 @@ class FastImageSampler(ImageSampler):
         # image given the options. (maybe this class needs to be
         # redesigned?  The interface to this function is pretty inscrutable.)
         im = ImageOps.fit(self.image,x.shape,self.sampling_method)
-        return array(im,dtype=Float)
+        return array(im,dtype=x.dtype)
 
 
 
@@ -255,8 +832,9 @@ class GenericImage(PatternGenerator):
     background. Images with no border have a background that is less
     of a contrast than a white or black one.
 
-    At present, rotation, size_normalization, etc. just resample; it
-    would be nice to support some interpolation options as well.
+    Rotation, size_normalization, etc. resample the image as
+    specified by the pattern_sampler (see PatternSampler's
+    interpolation and pyramid parameters).
     """
 
     __abstract = True
@@ -280,6 +858,12 @@ class GenericImage(PatternGenerator):
         to make it possible to use very large databases of images without
         running out of memory.""")
 
+    image_store = param.ClassSelector(class_=ImageStore,default=None,allow_None=True,
+        precedence=-1,doc="""
+        Optional ImageStore from which to take the image, if it
+        contains the file that would otherwise be read (for
+        subclasses that read images from files).""")
+
 
     def _get_image(self,p):
         """
@@ -289,6 +873,17 @@ class GenericImage(PatternGenerator):
         """
         raise NotImplementedError
 
+
+    def _stored_image(self,p,filename):
+        """
+        Return the image from the given file in p.image_store, or
+        None if there is no image_store or it does not contain the
+        file.
+        """
+        if p.image_store is not None and filename in p.image_store:
+            return p.image_store[filename]
+        return None
+
     # CEB: not currently possible, because _get_image needs access to p
     #image = property(_get_image,_set_image,_del_image,doc=" ")
 
@@ -322,7 +917,7 @@ class GenericImage(PatternGenerator):
         """
         state = super(GenericImage,self).__getstate__()
 
-        if '_image' in state and state['_image'] is not None:
+        if '_image' in state and isinstance(state['_image'],Image.Image):
             import StringIO
             f = StringIO.StringIO()
             image = state['_image']
@@ -340,7 +935,7 @@ class GenericImage(PatternGenerator):
         # CEBALERT: Need to figure out how state['_image'] could ever
         # actually be None; apparently it is sometimes (see SF
         # #2276819).
-        if '_image' in state and state['_image'] is not None:
+        if '_image' in state and isinstance(state['_image'],str):
             import StringIO
             state['_image'] = Image.open(StringIO.StringIO(state['_image']))
         super(GenericImage,self).__setstate__(state)
@@ -354,6 +949,11 @@ class FileImage(GenericImage):
     The image at the supplied filename is converted to grayscale if it
     is not already a grayscale image. See Image's Image class for
     details of supported image file formats.
+
+    Unless the pattern_sampler is a FastImageSampler (which works on
+    the image itself), the converted image is kept in image_cache, so
+    that it is not read again while it remains there (even with
+    cache_image=False), and may be read in advance by a prefetcher.
     """
 
     filename = param.Filename(default='images/ellen_arthur.pgm',precedence=0.9,doc="""
@@ -361,6 +961,13 @@ class FileImage(GenericImage):
         The image can be in any format accepted by PIL, e.g. PNG, JPG, TIFF, or PGM.
         """)
 
+    prefetcher = param.ClassSelector(class_=ImagePrefetcher,default=None,allow_None=True,
+        precedence=-1,doc="""
+        Optional ImagePrefetcher through which to read images, so that
+        the images expected to be drawn next (e.g. those following the
+        current one in a database presented in order) are read in the
+        background.""")
+
 
     def __init__(self, **params):
         super(FileImage,self).__init__(**params)
@@ -369,9 +976,17 @@ class FileImage(GenericImage):
 
 
     def _get_image(self,p):
+        stored = self._stored_image(p,p.filename)
+        if stored is not None:
+            return stored
         if p.filename!=self.last_filename or self._image is None:
             self.last_filename=p.filename
-            self._image = ImageOps.grayscale(Image.open(p.filename))
+            if isinstance(p.pattern_sampler,FastImageSampler):
+                self._image = ImageOps.grayscale(Image.open(p.filename))
+            elif p.prefetcher is not None:
+                self._image = p.prefetcher.load(p.filename)
+            else:
+                self._image = load_image(p.filename)
         return self._image
 
 
@@ -379,11 +994,30 @@ class FileImage(GenericImage):
 class NumpyFile(GenericImage):
     """
     Read an array from a Numpy-format file.
+
+    The array may be a single image, or a stack of images (a 3D array
+    whose first axis is the image number) from which one is selected
+    by index.  With mmap_mode set, the file is memory mapped rather
+    than read, so that only the parts of it actually sampled (e.g. of
+    the selected image) are read from disk.
     """
 
     filename = param.Filename(default='images/numpy_array_feret_photo.npy',precedence=0.9,doc="""
         File path (can be relative to Param's base path) to the Numpy file.""")
 
+    index = param.Integer(default=0,precedence=0.91,doc="""
+        For a 3D array, the index (along the first axis) of the image
+        to use; ignored for a 2D array.""")
+
+    mmap_mode = param.ObjectSelector(default=None,objects=[None,'r','c'],
+        precedence=-1,doc="""
+        If not None, the mode in which to memory map the file (see
+        numpy.load): 'r' for read-only access, or 'c' for
+        copy-on-write, which also allows whole_pattern_output_fns to
+        modify the image without copying it first.  With 'c', the
+        file is mapped afresh for each pattern, so that the changes
+        made by whole_pattern_output_fns do not accumulate.""")
+
     # Inherits from GenericImage, overriding defaults to disable rescaling
     pattern_sampler = param.ClassSelector(class_=ImageSampler,
         default=PatternSampler(background_value_fn=edge_average,
@@ -395,10 +1029,22 @@ class NumpyFile(GenericImage):
         super(NumpyFile,self).__init__(**params)
         # Saves the last filename loaded, to avoid unnecessary reloading
         self.last_filename = None
+        self.last_mmap_mode = None
 
 
     def _get_image(self,p):
-        if p.filename!=self.last_filename or self._image is None:
+        stored = self._stored_image(p,p.filename)
+        if stored is not None:
+            return stored
+        if p.filename!=self.last_filename or p.mmap_mode!=self.last_mmap_mode or \
+                self._image is None or p.mmap_mode=='c':
             self.last_filename=p.filename
-            self._image = numpy.load((p.filename))
+            self.last_mmap_mode=p.mmap_mode
+            self._image = numpy.load(p.filename,mmap_mode=p.mmap_mode)
+            if p.mmap_mode is None:
+                # Not to be modified, so that the pattern_sampler
+                # can reuse what it computes from it
+                self._image.flags.writeable = False
+        if self._image.ndim == 3:
+            return self._image[p.index]
         return self._image
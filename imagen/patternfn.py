@@ -4,6 +4,11 @@ Family of two-dimensional functions indexed by x and y.
 All functions are written to be valid both for scalar x and y, and for
 numpy arrays of x and y (in which case the result is also an array);
 the functions therefore have the same mathematical behaviour as numpy.
+
+Some functions also accept an optional out array, into which the
+result is written (and which is then returned), and an optional work
+array of the same shape for intermediate values, so that patterns can
+be computed repeatedly without allocating any new arrays.
 """
 
 from __future__ import with_statement
@@ -15,8 +20,8 @@ __version__='$Revision$'
 from math import pi
 
 from numpy.oldnumeric import where,maximum,cos,sqrt,divide,greater_equal,bitwise_xor,exp
-from numpy.oldnumeric import arcsin,logical_and,logical_or,less,minimum
-from numpy import seterr, log
+from numpy.oldnumeric import arcsin,logical_and,logical_or,less,less_equal,minimum
+from numpy import seterr, log, empty_like, multiply, add, absolute
 
 from contextlib import contextmanager
 
@@ -44,19 +49,67 @@ def float_error_ignore():
     seterr(**oldsettings)
 
 
-def gaussian(x, y, xsigma, ysigma):
+def _zero(x, out):
+    """Return an array of zeros shaped like x, using out if supplied."""
+    if out is None:
+        return x*0.0
+    out.fill(0.0)
+    return out
+
+
+def gaussian_extent(sigma, tolerance):
+    """
+    Distance from the center beyond which a Gaussian fall-off of the
+    given sigma, exp(-d^2/(2*sigma^2)), is smaller than tolerance.
+    """
+    if sigma == 0.0:
+        return 0.0
+    if tolerance <= 0.0:
+        return float('inf')
+    return sigma*sqrt(-2.0*log(tolerance))
+
+
+def gaussian(x, y, xsigma, ysigma, out=None, work=None):
     """
     Two-dimensional oriented Gaussian pattern (i.e., 2D version of a
     bell curve, like a normal distribution but not necessarily summing
     to 1.0).
     """
     if xsigma==0.0 or ysigma==0.0:
+        return _zero(x,out)
+
+    with float_error_ignore():
+        if out is None:
+            x_w = divide(x,xsigma)
+            y_h = divide(y,ysigma)
+            return exp(-0.5*x_w*x_w + -0.5*y_h*y_h)
+
+        if work is None:
+            work = empty_like(out)
+        divide(x,xsigma,out)
+        multiply(out,out,out)
+        multiply(out,-0.5,out)
+        divide(y,ysigma,work)
+        multiply(work,work,work)
+        multiply(work,-0.5,work)
+        add(out,work,out)
+        return exp(out,out)
+
+
+def gaussian_profile(x, sigma):
+    """
+    One-dimensional Gaussian, exp(-x^2/(2*sigma^2)).
+
+    gaussian(x,y,xsigma,ysigma) is the product of
+    gaussian_profile(x,xsigma) and gaussian_profile(y,ysigma) (up to
+    floating-point rounding).
+    """
+    if sigma==0.0:
         return x*0.0
 
     with float_error_ignore():
-        x_w = divide(x,xsigma)
-        y_h = divide(y,ysigma)
-        return exp(-0.5*x_w*x_w + -0.5*y_h*y_h)
+        x_w = divide(x,sigma)
+        return exp(-0.5*x_w*x_w)
 
 
 def log_gaussian(x, y, x_sigma, y_sigma, mu):
@@ -100,12 +153,22 @@ def exponential(x, y, xscale, yscale):
         return exp(-sqrt(x_w*x_w+y_h*y_h))
 
 
-def gabor(x, y, xsigma, ysigma, frequency, phase):
+def gabor(x, y, xsigma, ysigma, frequency, phase, out=None, work=None):
     """
     Gabor pattern (sine grating multiplied by a circular Gaussian).
     """
     if xsigma==0.0 or ysigma==0.0:
-        return x*0.0
+        return _zero(x,out)
+
+    if out is not None:
+        if work is None:
+            work = empty_like(out)
+        gaussian(x,y,xsigma,ysigma,out,work)
+        multiply(out,0.5,out)
+        multiply(y,2*pi*frequency,work)
+        add(work,phase,work)
+        cos(work,work)
+        return multiply(out,work,out)
 
     with float_error_ignore():
         x_w = divide(x,xsigma)
@@ -119,10 +182,22 @@ def gabor(x, y, xsigma, ysigma, frequency, phase):
 # size parameter and ignores it, which is very confusing.  I guess
 # it's called thickness to match ring, but matching gaussian and disk
 # is probably more important.
-def line(y, thickness, gaussian_width):
+def line(y, thickness, gaussian_width, out=None):
     """
     Infinite-length line with a solid central region, then Gaussian fall-off at the edges.
     """
+    if out is not None:
+        # out is the distance outside the solid central region
+        add(absolute(y,out),-thickness/2.0,out)
+        sigmasq = gaussian_width*gaussian_width
+        if sigmasq==0.0:
+            return less_equal(out,0.0,out)
+        maximum(out,0.0,out)
+        multiply(out,out,out)
+        with float_error_ignore():
+            divide(out,-2*sigmasq,out)
+            return exp(out,out)
+
     distance_from_line = abs(y)
     gaussian_y_coord = distance_from_line - thickness/2.0
     sigmasq = gaussian_width*gaussian_width
@@ -136,12 +211,33 @@ def line(y, thickness, gaussian_width):
     return where(gaussian_y_coord<=0, 1.0, falloff)
 
 
-def disk(x, y, height, gaussian_width):
+def disk(x, y, height, gaussian_width, out=None, work=None):
     """
     Circular disk with Gaussian fall-off after the solid central region.
     """
     disk_radius = height/2.0
 
+    if out is not None:
+        if work is None:
+            work = empty_like(out)
+        # x is no longer needed once work is first written, so work
+        # may be the same array as x.
+        multiply(x,x,out)
+        multiply(y,y,work)
+        add(out,work,out)
+        sqrt(out,out)
+        # out is now the distance outside the disk
+        add(out,-disk_radius,out)
+        sigmasq = gaussian_width*gaussian_width
+        if sigmasq==0.0:
+            return less_equal(out,0.0,out)
+        # Inside the disk the fall-off is exp(0.0), i.e. 1.0
+        maximum(out,0.0,out)
+        multiply(out,out,out)
+        with float_error_ignore():
+            divide(out,-2*sigmasq,out)
+            return exp(out,out)
+
     distance_from_origin = sqrt(x**2+y**2)
     distance_outside_disk = distance_from_origin - disk_radius
     sigmasq = gaussian_width*gaussian_width
@@ -186,22 +282,25 @@ def smooth_rectangle(x, y, rec_w, rec_h, gaussian_width_x, gaussian_width_y):
     """
     Rectangle with a solid central region, then Gaussian fall-off at the edges.
     """
+    return minimum(smooth_edge(x,rec_w,gaussian_width_x),
+                   smooth_edge(y,rec_h,gaussian_width_y))
 
-    gaussian_x_coord = abs(x)-rec_w/2.0
-    gaussian_y_coord = abs(y)-rec_h/2.0
+
+def smooth_edge(x, width, gaussian_width):
+    """
+    One-dimensional profile of smooth_rectangle along an axis: a solid
+    central region of the given width, then Gaussian fall-off.
+    """
+    gaussian_x_coord = abs(x)-width/2.0
 
     box_x=less(gaussian_x_coord,0.0)
-    box_y=less(gaussian_y_coord,0.0)
-    sigmasq_x=gaussian_width_x*gaussian_width_x
-    sigmasq_y=gaussian_width_y*gaussian_width_y
+    sigmasq_x=gaussian_width*gaussian_width
 
     with float_error_ignore():
         falloff_x=x*0.0 if sigmasq_x==0.0 else \
             exp(divide(-gaussian_x_coord*gaussian_x_coord,2*sigmasq_x))
-        falloff_y=y*0.0 if sigmasq_y==0.0 else \
-            exp(divide(-gaussian_y_coord*gaussian_y_coord,2*sigmasq_y))
 
-    return minimum(maximum(box_x,falloff_x), maximum(box_y,falloff_y))
+    return maximum(box_x,falloff_x)
 
 
 
@@ -4,21 +4,391 @@ PatternGenerator abstract class and basic example concrete class.
 __version__='$Revision$'
 
 
+import os
+import math
+import threading
 from math import pi
+from multiprocessing import Pool, cpu_count, current_process
+from multiprocessing.pool import ThreadPool
+from multiprocessing.sharedctypes import RawArray
 
-from numpy import add, subtract, cos, sin
+import numpy
+from numpy import add, subtract, cos, sin, newaxis
 
 import param
 from param.parameterized import ParamOverrides
 
 from dataviews import SheetView
 from dataviews.boundingregion import BoundingBox, BoundingRegionParameter
-from dataviews.sheetcoords import SheetCoordinateSystem
+from dataviews.sheetcoords import SheetCoordinateSystem, Slice
 from dataviews.options import options, StyleOpts
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    from dataviews.odict import OrderedDict # pyflakes:ignore (try/except import)
+
 from transferfn import TransferFn
 
 
+class LRUCache(object):
+    """
+    Mapping of bounded size that discards the least recently used
+    entries first.
+
+    The number of entries can be limited by maxsize and, for values
+    that report their memory use through an nbytes attribute
+    (e.g. numpy arrays, or tuples of them), the total memory use can
+    be limited by maxbytes.  A maxsize of 0 disables caching
+    altogether, and a maxsize of None imposes no limit.  Counts of
+    hits and misses are kept so that the effectiveness of a cache can
+    be checked.
+
+    All operations are protected by a lock, so a cache can be shared
+    by threads (e.g. those of Composite's parallel option).
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._lock = threading.Lock()
+        self.clear()
+
+
+    @staticmethod
+    def sizeof(value):
+        """Return the number of bytes used by value, if known, else 0."""
+        if isinstance(value,tuple):
+            return sum(LRUCache.sizeof(v) for v in value)
+        return getattr(value,'nbytes',0)
+
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for key, marking it as most recently
+        used, or default if there is no such entry.
+        """
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+
+    def put(self, key, value):
+        """
+        Store value for key, evicting the least recently used entries
+        as necessary to respect maxsize and maxbytes.
+        """
+        nbytes = self.sizeof(value)
+        with self._lock:
+            self._discard(key)
+            if self.maxsize == 0 or (self.maxbytes is not None and nbytes > self.maxbytes):
+                return
+            self._entries[key] = (value,nbytes)
+            self.nbytes += nbytes
+            while (self.maxsize is not None and len(self._entries) > self.maxsize) or \
+                    (self.maxbytes is not None and self.nbytes > self.maxbytes):
+                self.nbytes -= self._entries.popitem(last=False)[1][1]
+
+
+    def discard(self, key):
+        """Remove the entry for key, if there is one."""
+        with self._lock:
+            self._discard(key)
+
+
+    def _discard(self, key):
+        entry = self._entries.pop(key,None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+
+    def clear(self):
+        """Remove all entries and reset the hit and miss counts."""
+        with self._lock:
+            self._entries = OrderedDict()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+    def info(self):
+        """Return a dictionary summarizing the state of the cache."""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._entries),
+                        nbytes=self.nbytes, maxsize=self.maxsize, maxbytes=self.maxbytes)
+
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+
+class Transform(object):
+    """
+    Transformation of the plane placing a pattern: rotation by
+    orientation and scaling by size about the origin, followed by
+    translation to (x,y).  This is the affine transformation with the
+    2x3 matrix::
+
+      [[size*cos(orientation), -size*sin(orientation), x],
+       [size*sin(orientation),  size*cos(orientation), y]]
+
+    The cosine and sine are computed only once for each Transform (and
+    not at all for one composed from others), and Transforms compose
+    with *, so that a pattern placed by transform child within a
+    pattern placed by transform parent is placed by parent*child.  E.g. Transform.of(p)*Transform.of(pg) gives the
+    values of x, y, orientation and size (see params) with which to
+    draw a generator pg as part of a pattern with the values p.
+    """
+
+    def __init__(self, x=0.0, y=0.0, orientation=0.0, size=1.0, cos=None, sin=None):
+        """
+        The cosine and sine of orientation may be supplied if already
+        known, e.g. when composing Transforms.
+        """
+        self.x = x
+        self.y = y
+        self.orientation = orientation
+        self.size = size
+        self.cos = math.cos(orientation) if cos is None else cos
+        self.sin = math.sin(orientation) if sin is None else sin
+
+
+    @classmethod
+    def of(cls, obj):
+        """
+        Return the Transform for the x, y, orientation, and size of
+        obj (e.g. a PatternGenerator or ParamOverrides), evaluating
+        each of them once.
+        """
+        return cls(obj.x,obj.y,obj.orientation,obj.size)
+
+
+    def __call__(self, x, y):
+        """Return the point (x,y) transformed."""
+        return (self.x+self.size*(x*self.cos-y*self.sin),
+                self.y+self.size*(x*self.sin+y*self.cos))
+
+
+    def __mul__(self, other):
+        """Return the Transform applying other, then this Transform."""
+        x,y = self(other.x,other.y)
+        # Angle-addition formulas, rather than evaluating cos and sin again
+        return Transform(x,y,other.orientation+self.orientation,other.size*self.size,
+                         self.cos*other.cos-self.sin*other.sin,
+                         self.sin*other.cos+self.cos*other.sin)
+
+
+    @property
+    def matrix(self):
+        """The 2x3 affine transformation matrix."""
+        return numpy.array([[self.size*self.cos,-self.size*self.sin,self.x],
+                            [self.size*self.sin, self.size*self.cos,self.y]])
+
+
+    def params(self):
+        """Return a dictionary of the x, y, orientation, and size values."""
+        return dict(x=self.x,y=self.y,orientation=self.orientation,size=self.size)
+
+
+
+class KernelBank(param.Parameterized):
+    """
+    Store of precomputed patterns, from which a PatternGenerator can
+    draw translated copies of patterns it has drawn before by simply
+    cutting out part of a larger array, rather than evaluating its
+    function again.
+
+    For each distinct set of parameter values other than x and y, the
+    pattern is computed once on a matrix about twice as wide and high
+    as the sheet, centered on the pattern.  Any pattern with the same
+    values that is translated by a whole number of matrix units (so
+    that its center is within the sheet) is then a window of that
+    matrix, and is equal to the computed pattern except for
+    floating-point rounding.  Pattern positions that fall between
+    matrix units are treated as distinct patterns.
+
+    To use a KernelBank, set the kernel_bank parameter of one or more
+    PatternGenerators to it.  Only PatternGenerators whose function
+    works directly on the coordinate grids (see render_batch) and
+    that have no mask, mask_shape, or output_fns use the bank; others
+    are drawn as usual.  Note that when a PatternGenerator uses the
+    bank, the values of all of its parameters are evaluated, not only
+    those used by its function.
+    """
+
+    maxbytes = param.Integer(default=2**27,bounds=(0,None),doc="""
+        Maximum number of bytes of precomputed patterns to keep; the
+        least recently used patterns are discarded first.""")
+
+    # Parameters that do not affect the precomputed pattern, either
+    # because they are handled when drawing from the bank or because
+    # generators using them do not use the bank.
+    _excluded_params = ('name','x','y','position','bounds','xdensity','ydensity',
+                        'scale','offset','mask','mask_shape','output_fns',
+                        'kernel_bank','support_tolerance')
+
+    def __init__(self,**params):
+        super(KernelBank,self).__init__(**params)
+        self.cache = LRUCache(maxsize=None,maxbytes=self.maxbytes)
+
+
+    def info(self):
+        """Return a dictionary summarizing the state of the bank's cache."""
+        return self.cache.info()
+
+
+    def _lookup(self,pg,p):
+        """
+        Return the pattern for PatternGenerator pg with the parameter
+        values p (before scale and offset are applied), as a read-only
+        view of a precomputed pattern, or None if the bank cannot
+        supply it.
+        """
+        if not (pg._batch_vectorized and _uses_base_call(pg)) or \
+           p.mask is not None or p.mask_shape is not None or p.output_fns:
+            return None
+
+        x_points,y_points = pg._coordinate_vectors(p.bounds,p.xdensity,p.ydensity)
+        rows,cols = len(y_points),len(x_points)
+        xstep,ystep = 1.0/p.xdensity,1.0/p.ydensity
+
+        # Matrix unit nearest the pattern center, and the remainder
+        center_x,center_y = p.x,p.y
+        col = int(round((center_x-x_points[0])/xstep))
+        row = int(round((y_points[0]-center_y)/ystep))
+        if not (-1 <= col <= cols and -1 <= row <= rows):
+            return None
+        x = center_x-(x_points[0]+col*xstep)
+        y = center_y-(y_points[0]-row*ystep)
+
+        values = dict((name,getattr(p,name)) for name in pg.params()
+                      if name not in self._excluded_params)
+        key = (type(pg),rows,cols,xstep,ystep,_dtype_key(p.dtype),
+               round(x/xstep,6),round(y/ystep,6),
+               tuple(sorted((k,_hashable(v)) for k,v in values.items())))
+        entry = self.cache.get(key)
+        if entry is None:
+            # Centered on the middle unit of a (2*rows+1,2*cols+1) matrix
+            bounds = BoundingBox(points=((-(cols+0.5)*xstep,-(rows+0.5)*ystep),
+                                         ((cols+0.5)*xstep,(rows+0.5)*ystep)))
+            kernel = pg(bounds=bounds,xdensity=p.xdensity,ydensity=p.ydensity,
+                        x=x,y=y,scale=1.0,offset=0.0,mask=None,kernel_bank=None,
+                        **values)
+            kernel.flags.writeable = False
+            # The values are kept, so that the ids of any unhashable
+            # ones in the key are not reused
+            entry = (kernel,values)
+            self.cache.put(key,entry)
+
+        return entry[0][rows-row:2*rows-row,cols-col:2*cols-col]
+
+
+class PatternMemo(param.Parameterized):
+    """
+    Store of patterns already drawn by PatternGenerators, so that a
+    pattern drawn again with the same parameter values is simply
+    copied rather than computed again.
+
+    Patterns are stored under the generator together with the values
+    of all of its parameters (other than name), evaluated once for
+    each draw.  Values that are themselves PatternGenerators, or that
+    cannot be hashed (such as mask arrays), make a pattern
+    unsuitable for storing, and it is then drawn as usual; other
+    objects are compared by identity.  Generators with their own
+    __call__ (which may keep state between calls) are also always
+    drawn as usual.
+
+    To use a PatternMemo, set the memo parameter of a Selector or
+    Sweeper to it, which is useful when the same few patterns are
+    presented over and over.
+    """
+
+    maxsize = param.Integer(default=128,bounds=(0,None),allow_None=True,doc="""
+        Maximum number of patterns to keep (None for no limit); the
+        least recently used patterns are discarded first.""")
+
+    maxbytes = param.Integer(default=2**27,bounds=(0,None),allow_None=True,doc="""
+        Maximum number of bytes of patterns to keep (None for no
+        limit); the least recently used patterns are discarded first.""")
+
+    def __init__(self,**params):
+        super(PatternMemo,self).__init__(**params)
+        self.cache = LRUCache(maxsize=self.maxsize,maxbytes=self.maxbytes)
+
+
+    def info(self):
+        """Return a dictionary summarizing the state of the memo's cache."""
+        return self.cache.info()
+
+
+    def draw(self,pg,out=None,**params_to_override):
+        """
+        Return the pattern of PatternGenerator pg with the given
+        parameter overrides, as pg._call_into(out,**params_to_override)
+        would, but copied from a stored pattern if possible.
+        """
+        if not _uses_base_call(pg):
+            return pg._call_into(out,**params_to_override)
+
+        # output_fns cannot be overridden when calling, so they are
+        # part of the key but are not passed
+        values = dict((name,getattr(pg,name)) for name in pg.params()
+                      if name not in params_to_override and
+                      name not in ('name','position','output_fns'))
+        values.update(params_to_override)
+        try:
+            key = (pg,_memo_value(pg.output_fns),
+                   tuple(sorted((k,_memo_value(v)) for k,v in values.items())))
+        except TypeError:
+            return pg(out=out,**values)
+
+        pattern = self.cache.get(key)
+        if pattern is None:
+            pattern = pg(**values)
+            pattern.flags.writeable = False
+            self.cache.put(key,pattern)
+
+        if out is not None:
+            out[...] = pattern
+            return out
+        return pattern.copy()
+
+
+# Coordinate vectors and rotated coordinate grids, shared by all
+# PatternGenerators.  Patterns are typically drawn over and over on
+# the same few sheets, often at the same positions, so the grids only
+# need to be built once for each distinct geometry.
+coordinate_cache = LRUCache(maxsize=64, maxbytes=2**25)
+
+# Masks drawn by mask_shape generators, shared by all
+# PatternGenerators.  A fixed aperture is typically applied to a
+# changing pattern, so each distinct mask need only be drawn once.
+mask_cache = LRUCache(maxsize=32, maxbytes=2**25)
+
+
 # CEBALERT: PatternGenerator has become a bit of a monster abstract
 # class.  Can it be split into the minimum required to specify the
 # interface, with a subclass implementing the rest (this subclass
@@ -114,13 +484,73 @@ class PatternGenerator(param.Parameterized):
         Optional function(s) to apply to the pattern array after it has been created.
         Can be used for normalization, thresholding, etc.""")
 
+    dtype = param.Parameter(default=numpy.float64,precedence=-1,doc="""
+        Numpy floating-point type of the patterns generated, and of
+        the coordinate arrays from which they are computed.
+
+        numpy.float32 halves the memory (and memory bandwidth) needed
+        compared to the default numpy.float64, at the cost of
+        precision.  Setting PatternGenerator.dtype changes the type
+        for all PatternGenerators that do not set their own.""")
+
+    kernel_bank = param.Parameter(default=None,precedence=-1,doc="""
+        Optional KernelBank from which to draw translated copies of
+        patterns already computed, rather than computing them again.""")
+
+    support_tolerance = param.Number(default=None,allow_None=True,bounds=(0.0,1.0),
+        precedence=-1,doc="""
+        If not None, PatternGenerators whose pattern is zero (or nearly
+        so) outside some compact region are evaluated only within the
+        rectangular part of the matrix enclosing that region, and the
+        rest of the matrix is simply filled with zeros.  Values of the
+        pattern (before scale and offset are applied) smaller than
+        support_tolerance may be treated as being outside the region,
+        e.g. to cut off the tails of Gaussian fall-offs.
+
+        This can make drawing small patterns on a large sheet much
+        faster.  It has no effect for patterns that do not determine
+        a region of support (see _support).""")
+
+    # Whether function() computes the pattern purely elementwise from
+    # the pattern_x and pattern_y coordinate grids (and scalar
+    # parameter values), and can therefore be applied to a whole
+    # stack of grids at once by render_batch().
+    _batch_vectorized = False
+
+    # Whether function() accepts an optional out array into which to
+    # draw the pattern (see __call__).  As for _function_uses_grids,
+    # a subclass overriding function() must set this again.
+    _function_out = False
+
+    # Whether a subclass's own __call__ accepts an optional out array
+    # like PatternGenerator.__call__ (see _call_into).
+    _call_out = False
+
+    # Whether function() uses the pattern_x and pattern_y coordinate
+    # grids, which otherwise need not be built (e.g. for patterns
+    # that just draw other PatternGenerators).  Only a setting made
+    # in the class that defines function() counts, so a subclass
+    # overriding function() gets the grids unless it sets this too
+    # (see _uses_grids).
+    _function_uses_grids = True
+
+    # Parameters that render_batch() varies across a stack of patterns
+    # by broadcasting, rather than by calling function() separately.
+    _batch_params = ('x','y','orientation','scale','offset')
+
+    # Approximate number of elements render_batch() computes at once
+    _batch_chunk_elements = 2**16
+
+    # Slice outside which the last pattern drawn by __call__ is zero
+    _zero_outside = None
+
 
     def __init__(self,**params):
         super(PatternGenerator, self).__init__(**params)
         self.set_matrix_dimensions(self.bounds, self.xdensity, self.ydensity)
 
 
-    def __call__(self,**params_to_override):
+    def __call__(self,out=None,**params_to_override):
         """
         Call the subclass's 'function' method on a rotated and scaled coordinate system.
 
@@ -128,6 +558,13 @@ class PatternGenerator(param.Parameterized):
         called without any params, uses the values for the Parameters
         as currently set on the object. Otherwise, any params
         specified override those currently set on the object.
+
+        If an array out of the appropriate shape and dtype is
+        supplied, the pattern is drawn into it (and it is returned)
+        rather than into a newly allocated array.  For PatternGenerators whose function
+        supports it, the pattern is then computed using only out and
+        scratch arrays kept by the PatternGenerator (see _scratch), so
+        that drawing patterns repeatedly allocates no new arrays.
         """
         if 'output_fns' in params_to_override:
             self.warning("Output functions specified through the call method will be ignored.")
@@ -141,38 +578,500 @@ class PatternGenerator(param.Parameterized):
         # position=params_to_override.get('position',None) if position
         # is not None: x,y = position
 
-        self._setup_xy(p.bounds,p.xdensity,p.ydensity,p.x,p.y,p.orientation)
-        fn_result = self.function(p)
-        self._apply_mask(p,fn_result)
+        # Dynamic values are drawn once per call (in the order in
+        # which _setup_xy has always drawn them), so that every step
+        # below uses the same position and orientation.
+        p.x,p.y,p.orientation = p.x,p.y,p.orientation
+
+        if out is not None and out.dtype != numpy.dtype(p.dtype):
+            raise ValueError("%s: out has dtype %s, but the pattern has dtype %s."
+                             % (self.name,out.dtype,numpy.dtype(p.dtype)))
+
+        slice_ = None
+        # Whether result is out or an array allocated here, rather
+        # than one returned by function (which may be kept elsewhere,
+        # e.g. cached, and so must not be scaled in place)
+        owned = True
+        result = self._draw_from_bank(p,out)
+        if result is None:
+            result = self._draw_separable(p,out)
+        if result is None:
+            slice_ = self._support_slice(p)
+            if _uses_grids(self):
+                self._setup_xy(p.bounds,p.xdensity,p.ydensity,p.x,p.y,p.orientation,p.dtype,slice_)
+            if slice_ is not None:
+                result = self._function_in_slice(p,slice_,out)
+            elif out is None:
+                result = self.function(p)
+                owned = False
+            else:
+                result = self._function_into(p,out)
+        self._apply_mask(p,result)
         if p.scale != 1.0:
-            result = p.scale * fn_result
-        else:
-            result = fn_result
+            if owned:
+                result *= p.scale
+            else:
+                result = p.scale * result
+                owned = True
         if p.offset != 0.0:
-            result += p.offset
+            if owned:
+                result += p.offset
+            else:
+                result = result + p.offset
+        result = as_float_dtype(result,p.dtype)
 
         for of in p.output_fns:
             of(result)
 
+        # Record the Slice outside which the result is known to be
+        # zero, if any (e.g. for Composite to combine only that part).
+        self._zero_outside = slice_ if (p.offset==0.0 and not p.output_fns) else None
+
         return result
 
 
-    def _setup_xy(self,bounds,xdensity,ydensity,x,y,orientation):
+    def _function_into(self,p,out):
+        """
+        Draw the pattern computed by function into the array out,
+        without allocating a new array if function supports that.
+        """
+        if self._function_out and _defined_with_function(self,'_function_out'):
+            result = self.function(p,out=out)
+        else:
+            result = self.function(p)
+        if result is not out:
+            out[...] = result
+        return out
+
+
+    def _draw_from_bank(self,p,out):
+        """
+        Return the pattern (before mask, scale, and offset) drawn from
+        p.kernel_bank into out (or a new array), or None if there is
+        no bank or it cannot supply the pattern.
+        """
+        kernel = None if p.kernel_bank is None else p.kernel_bank._lookup(self,p)
+        if kernel is None:
+            return None
+        if out is None:
+            return kernel.copy()
+        out[...] = kernel
+        return out
+
+
+    def _separable(self,p,x,y):
+        """
+        For a pattern whose value at each point is op(fx(x),fy(y)) for
+        the coordinates x and y of the pattern at that point, return
+        (fx(x),fy(y),op) for the vectors x and y; either profile may be
+        None if the pattern does not vary with that coordinate.
+
+        Returns None if the pattern cannot be separated in this way,
+        as for the default implementation.  Subclasses that override
+        this method are drawn from the two profiles when their
+        orientation is a multiple of pi/2 (see _draw_separable).
+        """
+        return None
+
+
+    def _draw_separable(self,p,out):
+        """
+        Return the pattern (before mask, scale, and offset) drawn into
+        out (or a new array) from its profiles along the matrix axes
+        (see _separable), or None if that is not possible.
+
+        This requires evaluating the pattern's function only
+        rows+cols times, rather than rows*cols times.
+        """
+        if type(self)._separable.im_func is PatternGenerator._separable.im_func or \
+           not _defined_with_function(self,'_separable') or \
+           type(self)._create_and_rotate_coordinate_arrays.im_func is not \
+           PatternGenerator._create_and_rotate_coordinate_arrays.im_func:
+            return None
+
+        orientation = p.orientation
+        c = cos(orientation)
+        s = sin(orientation)
+        if abs(s) < _axis_tolerance:
+            along_rows = False
+        elif abs(c) < _axis_tolerance:
+            along_rows = True
+        else:
+            return None
+
+        x_points,y_points = self._coordinate_vectors(p.bounds,p.xdensity,p.ydensity,p.dtype)
+        x_points = x_points-p.x
+        y_points = y_points-p.y
+        # As in _create_and_rotate_coordinate_arrays, without the
+        # terms that are (nearly) zero
+        if along_rows:
+            profiles = self._separable(p,s*y_points,-s*x_points)
+        else:
+            profiles = self._separable(p,c*x_points,c*y_points)
+        if profiles is None:
+            return None
+
+        fx,fy,operator = profiles
+        row_profile,col_profile = (fx,fy) if along_rows else (fy,fx)
+        if out is None:
+            out = numpy.empty((len(y_points),len(x_points)),p.dtype)
+        if row_profile is None:
+            out[...] = col_profile[newaxis,:]
+        elif col_profile is None:
+            out[...] = row_profile[:,newaxis]
+        else:
+            operator(row_profile[:,newaxis],col_profile[newaxis,:],out)
+        return out
+
+
+    def _support(self,p):
+        """
+        Return (half_width,half_height) of the region around the
+        pattern's center, in the pattern's own (unrotated) coordinates,
+        outside of which the pattern (before scale and offset) is
+        smaller than p.support_tolerance; either may be infinite.
+
+        Returns None if there is no such region, as for the default
+        implementation; subclasses drawing compact patterns should
+        override this method to support evaluation restricted to the
+        region (see support_tolerance).
+        """
+        return None
+
+
+    def _support_slice(self,p):
+        """
+        Return the Slice of the matrix enclosing the pattern's region
+        of support (see _support), cropped to the matrix, or None if
+        the whole matrix must be evaluated.
+        """
+        if p.support_tolerance is None or not _defined_with_function(self,'_support'):
+            return None
+        support = self._support(p)
+        if support is None:
+            return None
+
+        # Axis-aligned half-extents of the rotated region.  Infinite
+        # extents are only meaningful when not multiplied by zero.
+        half_width,half_height = support
+        x,y,orientation = p.x,p.y,p.orientation
+        c = abs(cos(orientation))
+        s = abs(sin(orientation))
+        x_extent = (half_width*c if c else 0.0) + (half_height*s if s else 0.0)
+        y_extent = (half_width*s if s else 0.0) + (half_height*c if c else 0.0)
+
+        left,bottom,right,top = p.bounds.lbrt()
+        if x_extent >= right-left and y_extent >= top-bottom:
+            return None
+
+        scs = SheetCoordinateSystem(p.bounds,p.xdensity,p.ydensity)
+        l = min(max(x-x_extent,left),right)
+        r = max(min(x+x_extent,right),left)
+        b = min(max(y-y_extent,bottom),top)
+        t = max(min(y+y_extent,top),bottom)
+        slice_ = Slice(BoundingBox(points=((l,b),(r,t))),scs)
+        slice_.crop_to_sheet(scs)
+        return slice_
+
+
+    def _function_in_slice(self,p,slice_,out=None):
+        """
+        Return a matrix (out, if supplied) that is zero except within
+        slice_, where the pattern computed by function is drawn.
+        Assumes _setup_xy has been called with slice_.
+        """
+        if out is None:
+            x_points,y_points = self._coordinate_vectors(p.bounds,p.xdensity,p.ydensity)
+            out = numpy.zeros((len(y_points),len(x_points)),dtype=p.dtype)
+        else:
+            out.fill(0.0)
+        submatrix = slice_.submatrix(out)
+        if submatrix.size:
+            self._function_into(p,submatrix)
+        return out
+
+
+    def _call_into(self,out,**params_to_override):
+        """
+        Call this PatternGenerator with the given parameter overrides,
+        drawing the pattern into the array out if it is not None.
+
+        Unlike calling with out directly, also works for
+        PatternGenerators that implement __call__ themselves.
+        """
+        if out is None:
+            return self(**params_to_override)
+        if self._call_out or _uses_base_call(self):
+            return self(out=out,**params_to_override)
+        out[...] = self(**params_to_override)
+        return out
+
+
+    def stream(self,times,out=None,**params_to_override):
+        """
+        Generator yielding the pattern at each of the given times in
+        turn, with param.Dynamic.time_fn set to that time.
+
+        The parameter overrides are used for every pattern, as for
+        __call__.  All the patterns are drawn into the same array
+        (out, if supplied), so any pattern that is needed after the
+        next one has been requested must be copied.  The time and the
+        state of this PatternGenerator are restored once the stream
+        ends (or is closed).
+        """
+        self.state_push()
+        try:
+            with param.Dynamic.time_fn as t:
+                for time in times:
+                    t(time)
+                    if out is None:
+                        # Copied, because the first pattern may be
+                        # owned by the generator (e.g. an image)
+                        out = numpy.array(self(**params_to_override))
+                    else:
+                        self._call_into(out,**params_to_override)
+                    yield out
+        finally:
+            self.state_pop()
+
+
+    def _scratch(self,name,like,dtype=None):
+        """
+        Return an uninitialized array with the shape of the array like,
+        and the given dtype (defaulting to that of like), reused for
+        every request with the same name, shape, and dtype.
+
+        Scratch arrays are private to this PatternGenerator and may be
+        overwritten by any call, so they must only be used for
+        temporary values.  For convenience, returns None if like is
+        None.
+        """
+        if like is None:
+            return None
+        dtype = like.dtype if dtype is None else numpy.dtype(dtype)
+        workspace = self.__dict__.setdefault('_workspace',{})
+        array = workspace.get(name)
+        if array is None or array.shape != like.shape or array.dtype != dtype:
+            array = workspace[name] = numpy.empty(like.shape,dtype)
+        return array
+
+
+    def render_batch(self,params_list=None,**params):
+        """
+        Return an array of shape (N,rows,cols) containing N patterns.
+
+        The patterns are specified either by params_list, a list of N
+        dictionaries of parameter overrides (as would be passed to
+        __call__), or by keyword arguments supplying a list, tuple, or
+        array of N values for a parameter (e.g. x, y, orientation, or
+        size).  Keyword arguments with any other kind of value apply
+        to all N patterns, as do the current values of parameters that
+        are not supplied (which are evaluated once per batch rather
+        than once per pattern).
+
+        For PatternGenerators whose function() works directly on the
+        coordinate grids, x, y, orientation, scale, and offset are
+        varied by broadcasting over a stack of coordinate grids, so
+        that patterns sharing the values of the remaining parameters
+        are computed together, by one call to function() per chunk of
+        roughly _batch_chunk_elements values.  Other PatternGenerators
+        are simply called once for each pattern.
+
+        Output functions cannot be supplied; the PatternGenerator's
+        own output_fns are applied to each pattern.
+        """
+        if 'output_fns' in params or any('output_fns' in item for item in params_list or []):
+            self.warning("Output functions specified through render_batch will be ignored.")
+            params.pop('output_fns',None)
+            if params_list is not None:
+                params_list = [dict((k,v) for k,v in item.items() if k!='output_fns')
+                               for item in params_list]
+        items = self._batch_items(params_list,params)
+
+        if not items:
+            p = ParamOverrides(self,dict((k,v) for k,v in params.items()
+                                         if not isinstance(v,(list,tuple,numpy.ndarray))))
+            x_points,y_points = self._coordinate_vectors(p.bounds,p.xdensity,p.ydensity)
+            return numpy.empty((0,len(y_points),len(x_points)),dtype=p.dtype)
+
+        if not (self._batch_vectorized and _uses_base_call(self)):
+            results = [self(**item) for item in items]
+            # As for the vectorized patterns below, the batch has the
+            # dtype of the first pattern
+            dtype = items[0].get('dtype',self.dtype)
+            return numpy.array(results,dtype=dtype).reshape((len(items),)+results[0].shape)
+
+        # Group the patterns by the values of the parameters that
+        # cannot be broadcast
+        groups = OrderedDict()
+        for i,item in enumerate(items):
+            key = tuple(sorted((k,_hashable(v)) for k,v in item.items()
+                               if k not in self._batch_params))
+            groups.setdefault(key,[]).append(i)
+
+        result = None
+        for indices in groups.values():
+            common = dict((k,v) for k,v in items[indices[0]].items()
+                          if k not in self._batch_params)
+            p = ParamOverrides(self,common)
+            values = {}
+            for name in self._batch_params:
+                default = getattr(p,name)
+                values[name] = numpy.array([items[i].get(name,default) for i in indices],dtype=float)
+
+            x_points,y_points = self._coordinate_vectors(p.bounds,p.xdensity,p.ydensity)
+            shape = (len(y_points),len(x_points))
+            if result is None:
+                result = numpy.empty((len(items),)+shape,dtype=p.dtype)
+            elif shape != result.shape[1:]:
+                raise ValueError("render_batch requires all patterns to have the same shape.")
+
+            # Patterns are computed in chunks small enough that the
+            # temporaries created by function() stay cache-sized.
+            chunk = max(1,self._batch_chunk_elements//(shape[0]*shape[1]))
+            for start in range(0,len(indices),chunk):
+                chunk_values = dict((k,v[start:start+chunk]) for k,v in values.items())
+                chunk_indices = indices[start:start+chunk]
+                if chunk_indices[-1]-chunk_indices[0] == len(chunk_indices)-1:
+                    block = result[chunk_indices[0]:chunk_indices[-1]+1]
+                else:
+                    block = numpy.empty((len(chunk_indices),)+shape,dtype=result.dtype)
+                self._setup_xy_batch(p.bounds,p.xdensity,p.ydensity,chunk_values['x'],
+                                     chunk_values['y'],chunk_values['orientation'],p.dtype)
+                self._function_into(p,block)
+
+                if p.mask_shape is None:
+                    self._apply_mask(p,block)
+                else:
+                    for j in range(len(block)):
+                        self._apply_mask(ParamOverrides(self,dict(common,x=chunk_values['x'][j],
+                                                                  y=chunk_values['y'][j],
+                                                                  orientation=chunk_values['orientation'][j])),
+                                         block[j])
+
+                if (chunk_values['scale'] != 1.0).any():
+                    block *= chunk_values['scale'][:,newaxis,newaxis]
+                if (chunk_values['offset'] != 0.0).any():
+                    block += chunk_values['offset'][:,newaxis,newaxis]
+
+                for pattern in block:
+                    for of in p.output_fns:
+                        of(pattern)
+
+                if block.base is not result:
+                    result[chunk_indices] = block
+
+        return result
+
+
+    def _batch_items(self,params_list,params):
+        """
+        Return the list of parameter override dictionaries, one per
+        pattern, specified by the arguments to render_batch().
+        """
+        sequences = dict((k,v) for k,v in params.items()
+                         if isinstance(v,(list,tuple,numpy.ndarray)))
+        lengths = set(len(v) for v in sequences.values())
+        if params_list is not None:
+            lengths.add(len(params_list))
+        if len(lengths) != 1:
+            raise ValueError("render_batch requires either params_list or "
+                             "sequences of parameter values, all of the same length.")
+        n = lengths.pop()
+
+        common = dict((k,v) for k,v in params.items() if k not in sequences)
+        items = []
+        for i in range(n):
+            item = dict(params_list[i]) if params_list is not None else {}
+            item.update(common)
+            for k,v in sequences.items():
+                item[k] = v[i]
+            items.append(item)
+        return items
+
+
+    def _setup_xy_batch(self,bounds,xdensity,ydensity,x,y,orientation,dtype=None):
+        """
+        As _setup_xy, but for 1D arrays of x, y, and orientation
+        values, producing stacks of coordinate matrices of shape
+        (N,rows,cols).
+        """
+        if len(x)==1:
+            self._setup_xy(bounds,xdensity,ydensity,x[0],y[0],orientation[0],dtype)
+            self.pattern_x = self.pattern_x[newaxis]
+            self.pattern_y = self.pattern_y[newaxis]
+            return
+
+        x_points,y_points = self._coordinate_vectors(bounds,xdensity,ydensity,dtype)
+
+        orientation = orientation[:,newaxis,newaxis].astype(x_points.dtype)
+        x = (x_points[newaxis,:]-x.astype(x_points.dtype)[:,newaxis])[:,newaxis,:]
+        y = (y_points[newaxis,:]-y.astype(y_points.dtype)[:,newaxis])[:,:,newaxis]
+
+        cos_o = cos(orientation)
+        sin_o = sin(orientation)
+        self.pattern_y = cos_o*y - sin_o*x
+        self.pattern_x = sin_o*y + cos_o*x
+
+
+    def _setup_xy(self,bounds,xdensity,ydensity,x,y,orientation,dtype=None,slice_=None):
         """
         Produce pattern coordinate matrices from the bounds and
         density (or rows and cols), and transforms them according to
-        x, y, and orientation.
+        x, y, and orientation.  The matrices have the given dtype, if
+        any, or else numpy's default float type.
+
+        If a Slice is supplied, the matrices cover only that part of
+        the full matrix.
         """
         self.debug(lambda:"bounds=%s, xdensity=%s, ydensity=%s, x=%s, y=%s, orientation=%s"%(bounds,xdensity,ydensity,x,y,orientation))
-        # Generate vectors representing coordinates at which the pattern
-        # will be sampled.
-
-        # CB: note to myself - use slice_._scs if supplied?
-        x_points,y_points = SheetCoordinateSystem(bounds,xdensity,ydensity).sheetcoordinates_of_matrixidx()
-
-        # Generate matrices of x and y sheet coordinates at which to
-        # sample pattern, at the correct orientation
-        self.pattern_x, self.pattern_y = self._create_and_rotate_coordinate_arrays(x_points-x,y_points-y,orientation)
+        lbrt = tuple(bounds.lbrt())
+        # The rotation method is part of the key in case a subclass
+        # transforms the coordinates differently.
+        key = ('grids',self._create_and_rotate_coordinate_arrays.im_func,
+               lbrt,xdensity,ydensity,x,y,orientation,_dtype_key(dtype),
+               None if slice_ is None else tuple(slice_))
+        grids = coordinate_cache.get(key)
+        if grids is None:
+            # Generate vectors representing coordinates at which the
+            # pattern will be sampled.
+            x_points,y_points = self._coordinate_vectors(bounds,xdensity,ydensity,dtype)
+            if slice_ is not None:
+                r1,r2,c1,c2 = slice_
+                x_points,y_points = x_points[c1:c2],y_points[r1:r2]
+
+            # Generate matrices of x and y sheet coordinates at which to
+            # sample pattern, at the correct orientation
+            grids = self._create_and_rotate_coordinate_arrays(x_points-x,y_points-y,orientation)
+
+            # The grids are shared between calls (and generators), so
+            # they must not be modified in place.
+            for grid in grids:
+                grid.flags.writeable = False
+            coordinate_cache.put(key,grids)
+
+        self.pattern_x, self.pattern_y = grids
+
+
+    def _coordinate_vectors(self,bounds,xdensity,ydensity,dtype=None):
+        """
+        Return the (cached) vectors of x and y sheet coordinates of the
+        centers of the matrix cells for the given bounds and densities,
+        with the given dtype if any.
+        """
+        key = ('vectors',tuple(bounds.lbrt()),xdensity,ydensity,_dtype_key(dtype))
+        vectors = coordinate_cache.get(key)
+        if vectors is None:
+            if _dtype_key(dtype) is None:
+                # CB: note to myself - use slice_._scs if supplied?
+                vectors = SheetCoordinateSystem(bounds,xdensity,ydensity).sheetcoordinates_of_matrixidx()
+            else:
+                vectors = tuple(v.astype(dtype) for v in
+                                self._coordinate_vectors(bounds,xdensity,ydensity))
+            for vector in vectors:
+                vector.flags.writeable = False
+            coordinate_cache.put(key,vectors)
+        return vectors
 
 
     def function(self,p):
@@ -199,20 +1098,54 @@ class PatternGenerator(param.Parameterized):
         # right and y decrease from left to right; I don't think it
         # can be rewritten in so little code otherwise - but please
         # prove me wrong.
-        pattern_y = subtract.outer(cos(orientation)*y, sin(orientation)*x)
-        pattern_x = add.outer(sin(orientation)*y, cos(orientation)*x)
+        cos_o = cos(orientation)
+        sin_o = sin(orientation)
+        pattern_y = subtract.outer(cos_o*y, sin_o*x)
+        pattern_x = add.outer(sin_o*y, cos_o*x)
         return pattern_x, pattern_y
 
 
+    def _cached_mask(self,p,ms,transform):
+        """
+        Return the mask drawn by mask_shape ms placed by transform, as
+        a read-only array from mask_cache (drawing and storing it
+        first if necessary).
+
+        The mask depends only on the values of ms's own parameters and
+        on the sheet geometry, which together make up the key.  Each
+        of ms's parameter values is evaluated once, and the mask is
+        drawn with those values.  Values that cannot be hashed are
+        identified by their ids, so they are kept along with the mask
+        (so that the ids cannot be reused while the mask is stored).
+        """
+        values = dict((name,getattr(ms,name)) for name in ms.params()
+                      if name not in _mask_excluded_params)
+        values.update(transform.params())
+        key = ('mask',type(ms),tuple(p.bounds.lbrt()),p.xdensity,p.ydensity,
+               _dtype_key(p.dtype),tuple(sorted((k,_hashable(v)) for k,v in values.items())))
+        entry = mask_cache.get(key)
+        if entry is None:
+            mask = ms(bounds=p.bounds,ydensity=p.ydensity,xdensity=p.xdensity,**values)
+            if mask.dtype != numpy.dtype(p.dtype):
+                mask = mask.astype(p.dtype)
+            mask.flags.writeable = False
+            entry = (mask,values)
+            mask_cache.put(key,entry)
+        return entry[0]
+
+
     def _apply_mask(self,p,mat):
         """Create (if necessary) and apply the mask to the given matrix mat."""
         mask = p.mask
         ms=p.mask_shape
         if ms is not None:
-            mask = ms(x=p.x+p.size*(ms.x*cos(p.orientation)-ms.y*sin(p.orientation)),
-                      y=p.y+p.size*(ms.x*sin(p.orientation)+ms.y*cos(p.orientation)),
-                      orientation=ms.orientation+p.orientation,size=ms.size*p.size,
-                      bounds=p.bounds,ydensity=p.ydensity,xdensity=p.xdensity)
+            transform = Transform.of(p)*Transform.of(ms)
+            if _mask_cacheable(ms):
+                mask = self._cached_mask(p,ms,transform)
+            else:
+                mask = ms._call_into(self._scratch('mask',mat,p.dtype),
+                          bounds=p.bounds,ydensity=p.ydensity,xdensity=p.xdensity,
+                          **transform.params())
         if mask is not None:
             mat*=mask
 
@@ -249,8 +1182,237 @@ class PatternGenerator(param.Parameterized):
 
 
     def __getitem__(self, coords):
+        return self._sheetview(self())[coords]
+
+
+    def _sheetview(self, data):
+        """Return a SheetView of the pattern array data."""
         label = self.__class__.__name__+ ' Pattern'
-        return SheetView(self(), self.bounds, label=label)[coords]
+        return SheetView(data, self.bounds, label=label)
+
+
+# Largest value of sin(orientation) or cos(orientation) for which a
+# pattern is treated as aligned with the matrix axes
+_axis_tolerance = 1e-12
+
+
+def _dtype_key(dtype):
+    """
+    Return the numpy dtype for dtype, or None for numpy's default
+    float type (for which the coordinates need no conversion).
+    """
+    if dtype is None or numpy.dtype(dtype) == numpy.dtype(float):
+        return None
+    return numpy.dtype(dtype)
+
+
+def as_float_dtype(array,dtype):
+    """
+    Return array converted to dtype if it is an array of some other
+    floating-point type, or else array itself.
+    """
+    if array.dtype.kind == 'f' and array.dtype != dtype:
+        return array.astype(dtype)
+    return array
+
+
+def _uses_base_call(pg):
+    """
+    Whether PatternGenerator pg is drawn by PatternGenerator.__call__
+    itself, rather than by a subclass's own __call__.
+    """
+    return type(pg).__call__.im_func is PatternGenerator.__call__.im_func
+
+
+def _uses_grids(pg):
+    """
+    Whether the function() of PatternGenerator pg uses the coordinate
+    grids, according to the _function_uses_grids setting of the class
+    that defines function().
+    """
+    cls = type(pg)
+    uses = _uses_grids_by_class.get(cls)
+    if uses is None:
+        owner = next(c for c in cls.__mro__ if 'function' in c.__dict__)
+        uses = _uses_grids_by_class[cls] = owner.__dict__.get('_function_uses_grids',True)
+    return uses
+
+_uses_grids_by_class = {}
+
+
+def _defined_with_function(pg,name):
+    """
+    Whether attribute name of PatternGenerator pg is defined by the
+    class that defines its function() (or by a subclass of that
+    class), so that it can be relied on to describe that function.
+
+    E.g. a subclass overriding function() of a pattern that defines
+    _separable must not be drawn from the original pattern's profiles
+    unless it also overrides _separable.
+    """
+    cls = type(pg)
+    key = (cls,name)
+    defined = _defined_with_function_by_class.get(key)
+    if defined is None:
+        mro = cls.__mro__
+        owner = next(i for i,c in enumerate(mro) if 'function' in c.__dict__)
+        definer = next(i for i,c in enumerate(mro) if name in c.__dict__)
+        defined = _defined_with_function_by_class[key] = definer <= owner
+    return defined
+
+_defined_with_function_by_class = {}
+
+
+def _draw_concurrently(draw,n,shape,dtype,workers=None,processes=False,groups=None):
+    """
+    Return an array of shape (n,)+shape, where each array[i] has
+    been filled in by calling draw(i,array[i]), using a pool of
+    worker threads or (if processes is True) processes.  workers is
+    the size of the pool, defaulting to the number of CPUs.
+
+    groups is an optional list of lists of indices that must be drawn
+    one after another by a single worker, e.g. because drawing them
+    uses the same PatternGenerator (whose coordinate and scratch
+    arrays would otherwise be shared between threads); by default,
+    each index can be drawn by any worker.
+
+    Thread pools persist between calls, one for each number of
+    workers.  A call made from within one of their threads (e.g. by
+    a parallel Composite inside another) draws without using a pool,
+    so that it cannot wait for threads that are waiting for it.
+
+    Worker processes are forked with a copy of the caller's state
+    (so draw need not be picklable, but processes can only be used
+    where _can_fork() is True), and draw into an array in shared
+    memory, so that the arrays they draw need not be pickled back.
+    Any other changes they make (e.g. to the state of random number
+    generators) are lost.  Because the copy must be of the state at
+    the time of the call, a new pool of processes is used for every
+    call, so processes are worthwhile only for many or costly
+    draws.  Within a worker process, thread pools are not used.
+    """
+    workers = workers or cpu_count()
+    if groups is None:
+        groups = [[i] for i in range(n)]
+
+    if not processes:
+        array = numpy.empty((n,)+shape,dtype)
+        def draw_group(group):
+            for i in group:
+                draw(i,array[i])
+        if getattr(_thread_pool_state,'in_worker',False):
+            for group in groups:
+                draw_group(group)
+        else:
+            _thread_pool(workers).map(_run_in_worker,[(draw_group,group) for group in groups])
+        return array
+
+    assert _can_fork(),"Worker processes cannot be forked here."
+    dtype = numpy.dtype(dtype)
+    buffer_ = RawArray('c',max(1,n*int(numpy.prod(shape))*dtype.itemsize))
+    pool = Pool(workers,_init_draw_worker,(draw,buffer_,dtype,(n,)+shape))
+    try:
+        pool.map(_draw_in_worker,groups,max(1,len(groups)//(4*workers)))
+    finally:
+        pool.close()
+        pool.join()
+    return _shared_array(buffer_,dtype,(n,)+shape)
+
+
+def _can_fork():
+    """
+    Whether _draw_concurrently can fork worker processes, i.e. the
+    platform supports fork and this is not itself a (daemonic) worker
+    process.
+    """
+    return hasattr(os,'fork') and not current_process().daemon
+
+
+# Persistent pools of threads used by _draw_concurrently, by size
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+_thread_pool_state = threading.local()
+
+def _thread_pool(workers):
+    with _thread_pools_lock:
+        pool = _thread_pools.get(workers)
+        if pool is None:
+            pool = _thread_pools[workers] = ThreadPool(workers)
+        return pool
+
+def _run_in_worker(task):
+    fn,arg = task
+    _thread_pool_state.in_worker = True
+    try:
+        fn(arg)
+    finally:
+        _thread_pool_state.in_worker = False
+
+
+def _shared_array(buffer_,dtype,shape):
+    """Return an array of the given dtype and shape using buffer_."""
+    return numpy.frombuffer(buffer_,dtype,int(numpy.prod(shape))).reshape(shape)
+
+
+# The draw function and shared array of a worker process
+_worker_draw = None
+
+def _init_draw_worker(draw,buffer_,dtype,shape):
+    global _worker_draw
+    _worker_draw = (draw,_shared_array(buffer_,dtype,shape))
+    # The threads of any pools were not copied by the fork, so
+    # parallel Composites must draw serially
+    _thread_pools.clear()
+    _thread_pool_state.in_worker = True
+
+def _draw_in_worker(group):
+    draw,array = _worker_draw
+    for i in group:
+        draw(i,array[i])
+
+
+# Parameters of a mask_shape generator that are not part of the key
+# for mask_cache, either because the mask is drawn with values
+# supplied from elsewhere or because they are required to be unset
+# (see _mask_cacheable).
+_mask_excluded_params = ('name','x','y','position','orientation','size',
+                         'bounds','xdensity','ydensity','mask','mask_shape',
+                         'output_fns','kernel_bank')
+
+
+def _mask_cacheable(ms):
+    """
+    Return True if the mask drawn by mask_shape generator ms depends
+    only on the values of its own parameters (and the sheet
+    geometry), so that it can be stored in mask_cache.
+    """
+    return (ms._batch_vectorized and _uses_base_call(ms) and mask_cache.maxsize != 0 and
+            ms.mask is None and ms.mask_shape is None and not ms.output_fns)
+
+
+def _memo_value(value):
+    """
+    Return a hashable stand-in for the parameter value value, for use
+    in a PatternMemo key, raising TypeError if there is none.
+    """
+    if isinstance(value,PatternGenerator):
+        raise TypeError("%s cannot be part of a PatternMemo key" % value.name)
+    if isinstance(value,(list,tuple)):
+        return tuple(_memo_value(v) for v in value)
+    if isinstance(value,BoundingBox):
+        return ('bounds',)+tuple(value.lbrt())
+    hash(value)
+    return value
+
+
+def _hashable(value):
+    """Return value if it can be hashed, or else its identity."""
+    try:
+        hash(value)
+    except TypeError:
+        return id(value)
+    return value
+
 
 # Override class type; must be set here rather than when mask_shape is declared,
 # to avoid referring to class not yet constructed
@@ -260,7 +1422,7 @@ PatternGenerator.params('mask_shape').class_=PatternGenerator
 # Trivial example of a PatternGenerator, provided for when a default is
 # needed.  The other concrete PatternGenerator classes are stored
 # elsewhere, to be imported as needed.
-from numpy.oldnumeric import ones, Float
+from numpy.oldnumeric import ones
 
 class Constant(PatternGenerator):
     """Constant pattern generator, i.e., a solid, uniform field of the same value."""
@@ -276,7 +1438,7 @@ class Constant(PatternGenerator):
 
         shape = SheetCoordinateSystem(p.bounds,p.xdensity,p.ydensity).shape
 
-        result = p.scale*ones(shape, Float)+p.offset
+        result = p.scale*ones(shape, p.dtype)+p.offset
         self._apply_mask(p,result)
 
         for of in p.output_fns:
@@ -5,15 +5,15 @@ __version__='$Revision$'
 
 import numpy as np
 
-from numpy.oldnumeric import zeros,floor,where,choose,less,greater,Int,random_array
 
 import param
 from param.parameterized import ParamOverrides
 
 from dataviews.sheetcoords import SheetCoordinateSystem
 
-from patterngenerator import PatternGenerator
+from patterngenerator import PatternGenerator, LRUCache, as_float_dtype, _hashable
 from imagen import Composite, Gaussian
+from numbergen import TimeAware
 
 
 
@@ -26,8 +26,23 @@ def seed(seed=None):
     RandomGenerator.random_generator.seed(seed)
 
 
-class RandomGenerator(PatternGenerator):
-    """2D random noise pattern generator abstract class."""
+class RandomGenerator(PatternGenerator, TimeAware):
+    """
+    2D random noise pattern generator abstract class.
+
+    By default, all instances draw from the RandomState shared through
+    the random_generator parameter.  If seed is set, an instance
+    instead draws from its own stream, seeded with that value, which
+    is unaffected by other generators (e.g. those being drawn at the
+    same time in other threads or processes).  Further independent
+    streams can be derived from such an instance with spawn().
+
+    If time_dependent is True, the instance's stream is instead
+    reseeded on each call, from a hash of the instance's name, the
+    time returned by time_fn, the global param.random_seed, and seed,
+    as for numbergen's RandomDistributions; the noise is then a fixed
+    function of time.
+    """
 
     __abstract = True
 
@@ -43,9 +58,60 @@ class RandomGenerator(PatternGenerator):
 
         Note that all instances will share this RandomState object,
         and hence its state. To create a RandomGenerator that has its
-        own state, set this parameter to a new RandomState instance.
+        own state, set this parameter to a new RandomState instance
+        (or set seed).
         """)
 
+    seed = param.Integer(default=None,allow_None=True,bounds=(0,2**32-1),
+        precedence=-1,doc="""
+        If not None, the seed for this instance's own stream of
+        random numbers, used instead of random_generator.""")
+
+    def __init__(self,**params):
+        super(RandomGenerator,self).__init__(**params)
+        self._random_state = None
+        self._time_random_state = None
+        self._spawned = 0
+        if self.time_dependent and 'name' not in params:
+            self.warning("Default object name used to set the seed: "
+                         "random values conditional on object instantiation order.")
+
+
+    def _stream(self,p):
+        """Return the RandomState to draw from for the parameter values p."""
+        if p.time_dependent:
+            time = p.time_fn()
+            if hasattr(time, 'numer'):
+                time = (int(time.numer()), int(time.denom()))
+            hashval = hash((self.name, time, param.random_seed, p.seed))
+            if self._time_random_state is None:
+                self._time_random_state = np.random.RandomState()
+            self._time_random_state.seed([hashval & 0xffffffff, (hashval >> 32) & 0xffffffff])
+            return self._time_random_state
+
+        if p.seed is None:
+            return p.random_generator
+        if self._random_state is None or self._random_state[0] != p.seed:
+            self._random_state = (p.seed,np.random.RandomState(p.seed))
+        return self._random_state[1]
+
+
+    def spawn(self,n):
+        """
+        Return a list of n new RandomStates, each with its own stream
+        independent of this instance's, e.g. for separate worker
+        processes to draw noise from (by setting random_generator).
+
+        The streams depend only on seed (which must be set) and on
+        the number of streams spawned before, so repeating the same
+        sequence of calls gives the same streams.
+        """
+        if self.seed is None:
+            raise ValueError("%s: seed must be set to spawn streams." % self.name)
+        first = self._spawned
+        self._spawned += n
+        return [np.random.RandomState([self.seed,first+i]) for i in xrange(n)]
+
 
     def _distrib(self,shape,p):
         """Method for subclasses to override with a particular random distribution."""
@@ -57,8 +123,9 @@ class RandomGenerator(PatternGenerator):
         p = ParamOverrides(self,params_to_override)
 
         shape = SheetCoordinateSystem(p.bounds,p.xdensity,p.ydensity).shape
+        p.random_generator = self._stream(p)
 
-        result = self._distrib(shape,p)
+        result = as_float_dtype(self._distrib(shape,p),p.dtype)
         self._apply_mask(p,result)
 
         for of in p.output_fns:
@@ -67,6 +134,37 @@ class RandomGenerator(PatternGenerator):
         return result
 
 
+    def render_batch(self,params_list=None,**params):
+        """
+        As PatternGenerator.render_batch, except that when all N
+        patterns have the same parameter values (apart from the
+        ignored x, y, orientation, and size) and there is no mask or
+        output_fns, the noise is drawn as a single (N,rows,cols)
+        array, giving the same values as drawing the patterns one at a
+        time.
+        """
+        items = self._batch_items(params_list,params)
+        keys = set(tuple(sorted((k,_hashable(v)) for k,v in item.items()
+                                if k not in ('x','y','orientation','size')))
+                   for item in items)
+        if len(keys) != 1:
+            return super(RandomGenerator,self).render_batch(params_list,**params)
+
+        p = ParamOverrides(self,items[0])
+        if p.mask is not None or p.mask_shape is not None or p.output_fns:
+            return super(RandomGenerator,self).render_batch(params_list,**params)
+
+        shape = SheetCoordinateSystem(p.bounds,p.xdensity,p.ydensity).shape
+        p.random_generator = self._stream(p)
+
+        if p.time_dependent:
+            # Every pattern at a given time is the same
+            result = np.empty((len(items),)+shape,dtype=p.dtype)
+            result[...] = self._distrib(shape,p)
+            return result
+        return as_float_dtype(self._distrib((len(items),)+shape,p),p.dtype)
+
+
 
 class UniformRandom(RandomGenerator):
     """2D uniform random noise pattern generator."""
@@ -91,7 +189,7 @@ class UniformRandomInt(RandomGenerator):
         The highest integer to be drawn from the distribution.""")
 
     def _distrib(self,shape,p):
-        return np.random.randint(p.low, p.high, shape)
+        return p.random_generator.randint(p.low, p.high, shape)
 
 
 
@@ -215,40 +313,97 @@ class RandomDotStereogram(PatternGenerator):
         ydisparity  = int(round(xsize*p.ydisparity))
         dotsize     = int(round(xsize*p.dotsize))
 
+        bigimage = self._dot_image(p.random_seed,p.dotdensity,dotsize,xsize,ysize)
+
+        result = p.offset + p.scale*bigimage[ (ysize/2)+ydisparity:(3*ysize/2)+ydisparity ,
+                                              (xsize/2)+xdisparity:(3*xsize/2)+xdisparity ]
+        result = as_float_dtype(result,p.dtype)
+
+        for of in p.output_fns:
+            of(result)
+
+        return result
+
+
+    @staticmethod
+    def _dot_image(random_seed,dotdensity,dotsize,xsize,ysize):
+        """
+        Return the (read-only) image of dots, twice the size of the
+        sheet in each direction, from which patterns with any
+        disparity are cut.  The image depends only on the arguments,
+        so e.g. the two patterns of a stereo pair share a single image.
+        """
+        key = (random_seed,dotdensity,dotsize,xsize,ysize)
+        bigimage = dot_image_cache.get(key)
+        if bigimage is not None:
+            return bigimage
+
         bigxsize = 2*xsize
         bigysize = 2*ysize
-        ndots=int(round(p.dotdensity * (bigxsize+2*dotsize) * (bigysize+2*dotsize) /
+        ndots=int(round(dotdensity * (bigxsize+2*dotsize) * (bigysize+2*dotsize) /
                         min(dotsize,xsize) / min(dotsize,ysize)))
-        halfdot = floor(dotsize/2)
+        halfdot = dotsize//2
 
         # Choose random colors and locations of square dots
-        random_seed = p.random_seed
+        random_state = np.random.RandomState(random_seed)
+        col = np.where(random_state.random_sample(ndots)>=0.5, 1.0, -1.0)
+        xpos = random_state.randint(0,bigxsize+2*dotsize,ndots) - halfdot
+        ypos = random_state.randint(0,bigysize+2*dotsize,ndots) - halfdot
 
-        random_array.seed(random_seed*12,random_seed*99)
-        col=where(random_array.random((ndots))>=0.5, 1.0, -1.0)
+        bigimage = _paint_squares((bigysize,bigxsize),ypos,xpos,dotsize,col)
+        bigimage.flags.writeable = False
+        dot_image_cache.put(key,bigimage)
+        return bigimage
 
-        random_array.seed(random_seed*122,random_seed*799)
-        xpos=floor(random_array.random((ndots))*(bigxsize+2*dotsize)) - halfdot
 
-        random_array.seed(random_seed*1243,random_seed*9349)
-        ypos=floor(random_array.random((ndots))*(bigysize+2*dotsize)) - halfdot
 
-        # Construct arrays of points specifying the boundaries of each
-        # dot, cropping them by the big image size (0,0) to (bigxsize,bigysize)
-        x1=xpos.astype(Int) ; x1=choose(less(x1,0),(x1,0))
-        y1=ypos.astype(Int) ; y1=choose(less(y1,0),(y1,0))
-        x2=(xpos+(dotsize-1)).astype(Int) ; x2=choose(greater(x2,bigxsize),(x2,bigxsize))
-        y2=(ypos+(dotsize-1)).astype(Int) ; y2=choose(greater(y2,bigysize),(y2,bigysize))
+# Images of dots for RandomDotStereogram, which are the same for each
+# pattern of a stereo pair, and for each presentation of a pattern.
+dot_image_cache = LRUCache(maxsize=8, maxbytes=2**26)
 
-        # Draw each dot in the big image, on a blank background
-        bigimage = zeros((bigysize,bigxsize))
-        for i in range(ndots):
-            bigimage[y1[i]:y2[i]+1,x1[i]:x2[i]+1] = col[i]
 
-        result = p.offset + p.scale*bigimage[ (ysize/2)+ydisparity:(3*ysize/2)+ydisparity ,
-                                              (xsize/2)+xdisparity:(3*xsize/2)+xdisparity ]
-
-        for of in p.output_fns:
-            of(result)
-
-        return result
+def _paint_squares(shape,rows,cols,size,values):
+    """
+    Return an array of the given shape, zero except where covered by
+    squares with edge length size and top left corners at the given
+    rows and cols (which may lie outside the array), each square
+    having the corresponding entry of values.  Where squares overlap,
+    later squares cover earlier ones.
+
+    Rather than painting each square in turn, the index of the last
+    square covering each element is found as the maximum, over a
+    size x size window, of the array of square indices placed at
+    their corners.  (Indices rather than values are placed, so that
+    overlapping squares are resolved as if painted in order.)
+    """
+    corners = np.empty((shape[0]+size,shape[1]+size),dtype=int)
+    corners.fill(-1)
+    # Squares whose corner is above or left of the array by size or
+    # more cannot cover any of it
+    visible = (rows>-size) & (cols>-size) & (rows<shape[0]) & (cols<shape[1])
+    indices = np.nonzero(visible)[0]
+    positions = (rows[visible]+size)*corners.shape[1] + cols[visible]+size
+    # Of the squares sharing a corner, only the last is placed
+    order = np.lexsort((indices,positions))
+    indices,positions = indices[order],positions[order]
+    last_there = np.ones(len(positions),dtype=bool)
+    last_there[:-1] = positions[1:]!=positions[:-1]
+    corners.flat[positions[last_there]] = indices[last_there]
+
+    # Maximum over windows of increasing width, which at most
+    # doubles each time, first down the rows and then across the
+    # columns
+    last = corners
+    for axis in (0,1):
+        width = 1
+        while width < size:
+            step = min(width,size-width)
+            ahead = [slice(None),slice(None)]
+            behind = [slice(None),slice(None)]
+            ahead[axis],behind[axis] = slice(step,None),slice(None,-step)
+            ahead,behind = tuple(ahead),tuple(behind)
+            np.maximum(last[ahead],last[behind].copy(),last[ahead])
+            width += step
+
+    # Index -1 (no square) selects the appended zero
+    return np.append(values,0.0)[last[size:,size:]]
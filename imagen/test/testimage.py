@@ -0,0 +1,188 @@
+"""
+Test cases for imagen.image
+"""
+
+import os
+import sys
+import Queue
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+from imagen.image import ImagePrefetcher, ImageStore, NumpyFile, PatternSampler, load_image, \
+    _downsample, _interpolate
+from imagen.transferfn import Scale, TransferFn
+
+
+class CountingTF(TransferFn):
+    """Counts the arrays it is applied to."""
+
+    def __init__(self,**params):
+        super(CountingTF,self).__init__(**params)
+        self.calls = 0
+
+    def __call__(self,x):
+        self.calls += 1
+
+
+class NumpyFilesTestCase(unittest.TestCase):
+    """
+    Test case with a temporary directory containing a Numpy file
+    for each of the arrays.
+    """
+
+    arrays = []
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filenames = [os.path.join(self.directory,'%d.npy'%i) for i in range(len(self.arrays))]
+        self.images = dict(zip(self.filenames,self.arrays))
+        for filename,image in self.images.items():
+            numpy.save(filename,image)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestPatternSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.image = numpy.random.RandomState(7).uniform(size=(6,8))
+
+    def test_interpolation_at_pixel_centers(self):
+        row,col = numpy.mgrid[0:6,0:8].astype(float)
+        for method in ('bilinear','bicubic'):
+            self.assertTrue(numpy.allclose(_interpolate(self.image,row,col,method),self.image))
+
+    def test_interpolation_of_linear_ramp(self):
+        r,c = numpy.mgrid[0:6,0:8].astype(float)
+        ramp = 0.3*r-0.2*c
+        # Interior positions, at least one pixel from the edges
+        row,col = numpy.meshgrid(numpy.linspace(1,4,7),numpy.linspace(1,6,11))
+        for method in ('bilinear','bicubic'):
+            self.assertTrue(numpy.allclose(_interpolate(ramp,row,col,method),0.3*row-0.2*col))
+
+    def test_prepared_image_reused(self):
+        tf = CountingTF()
+        sampler = PatternSampler(whole_pattern_output_fns=[tf])
+        self.image.flags.writeable = False
+        x,y = numpy.meshgrid(numpy.linspace(-3,3,5),numpy.linspace(-2,2,4))
+        first = sampler(self.image,x,y,1.0,1.0)
+        second = sampler(self.image,x,y,1.0,1.0)
+        self.assertEqual(tf.calls,1)
+        self.assertEqual(sampler._prepared.hits,1)
+        self.assertTrue(numpy.array_equal(first,second))
+
+    def test_downsample_block_means(self):
+        blocks = self.image.reshape(3,2,4,2).mean(axis=3).mean(axis=1)
+        self.assertTrue(numpy.allclose(_downsample(self.image),blocks))
+        # An odd last row is repeated
+        odd = _downsample(self.image[:5])
+        self.assertTrue(numpy.allclose(odd[:2],blocks[:2]))
+        self.assertTrue(numpy.allclose(odd[2],self.image[4].reshape(4,2).mean(axis=1)))
+
+    def test_pyramid_level(self):
+        sampler = PatternSampler(pyramid=True)
+        blocks = self.image.reshape(3,2,4,2).mean(axis=3).mean(axis=1)
+        # Samples at the centers of the 2x2 blocks
+        x,y = numpy.meshgrid(numpy.arange(-3.0,4.0,2.0),numpy.arange(2.0,-3.0,-2.0))
+        pattern = sampler(self.image,x,y,1.0,1.0)
+        self.assertEqual(len(sampler._levels),1)
+        self.assertTrue(numpy.allclose(sampler._levels[0],blocks))
+        self.assertTrue(numpy.allclose(pattern,blocks))
+
+
+class TestNumpyFile(NumpyFilesTestCase):
+
+    arrays = [numpy.arange(48.0).reshape(3,4,4)]
+
+    def test_memory_mapped_stack(self):
+        patterns = []
+        filename = self.filenames[0]
+        for index in (0,2):
+            read = NumpyFile(filename=filename,index=index,pattern_sampler=PatternSampler(),
+                             xdensity=4,ydensity=4)()
+            for mmap_mode in ('r','c'):
+                mapped = NumpyFile(filename=filename,index=index,mmap_mode=mmap_mode,
+                                   pattern_sampler=PatternSampler(),xdensity=4,ydensity=4)()
+                self.assertTrue(numpy.array_equal(mapped,read))
+            patterns.append(read)
+        self.assertFalse(numpy.array_equal(*patterns))
+
+    def test_copy_on_write_leaves_file(self):
+        sampler = PatternSampler(whole_pattern_output_fns=[Scale(scale=2.0)])
+        image = NumpyFile(filename=self.filenames[0],index=1,mmap_mode='c',pattern_sampler=sampler,
+                          xdensity=4,ydensity=4)
+        first = image()
+        self.assertTrue(numpy.array_equal(image(),first))
+        self.assertTrue(numpy.array_equal(numpy.load(self.filenames[0]),self.arrays[0]))
+
+    def test_uncached_image_releases_prepared(self):
+        sampler = PatternSampler()
+        image = NumpyFile(filename=self.filenames[0],index=1,cache_image=False,
+                          pattern_sampler=sampler,xdensity=4,ydensity=4)
+        image()
+        self.assertEqual(len(sampler._prepared),0)
+        self.assertEqual(sampler._levels,[])
+
+
+class TestImageStore(NumpyFilesTestCase):
+
+    arrays = [numpy.random.RandomState(2).uniform(size=shape) for shape in [(4,6),(5,5),(3,7)]]
+
+    def test_load_image_cached(self):
+        filename = self.filenames[0]
+        image = load_image(filename)
+        self.assertFalse(image.flags.writeable)
+        self.assertTrue(numpy.array_equal(image,self.images[filename]))
+        self.assertTrue(load_image(filename) is image)
+
+    def test_store(self):
+        path = os.path.join(tempfile.mkdtemp(),'store')
+        try:
+            store = ImageStore.create(path,self.directory,dtype=numpy.float64)
+            self.assertEqual(store.filenames(),self.filenames)
+            for filename,image in self.images.items():
+                self.assertTrue(filename in store)
+                self.assertFalse(store[filename].flags.writeable)
+                self.assertTrue(numpy.array_equal(store[filename],image))
+            filename = self.filenames[1]
+            stored = NumpyFile(filename=filename,image_store=store,pattern_sampler=PatternSampler(),
+                               xdensity=10,ydensity=10)
+            read = NumpyFile(filename=filename,pattern_sampler=PatternSampler(),
+                             xdensity=10,ydensity=10)
+            self.assertTrue(numpy.array_equal(stored(),read()))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+
+class TestImagePrefetcher(NumpyFilesTestCase):
+
+    arrays = [numpy.ones((2,2))*i for i in range(3)]
+
+    def test_filenames_modified_in_place(self):
+        prefetcher = ImagePrefetcher(filenames=self.filenames[:1])
+        prefetcher.load(self.filenames[0])
+        prefetcher.filenames.extend(self.filenames[1:])
+        prefetcher.load(self.filenames[1])
+        self.assertTrue(self.filenames[2] in prefetcher._pending)
+        prefetcher._pending[self.filenames[2]][0].wait()
+        self.assertTrue(numpy.array_equal(prefetcher.load(self.filenames[2]),2*numpy.ones((2,2))))
+        self.assertEqual(prefetcher.info()['hits'],1)
+        prefetcher.stop()
+
+    def test_stop_after_entry_taken(self):
+        # A queued file whose entry load() has already taken
+        prefetcher = ImagePrefetcher(filenames=self.filenames)
+        prefetcher._queue = Queue.Queue()
+        prefetcher._queue.put((self.filenames[0],[threading.Event(),None,None]))
+        prefetcher.stop()
+        self.assertEqual(prefetcher.info()['pending'],0)
+
+
+if __name__ == "__main__":
+    import nose
+    nose.runmodule(argv=[sys.argv[0], "--logging-level", "ERROR"])
@@ -0,0 +1,531 @@
+"""
+Test cases for PatternGenerator
+"""
+
+import sys
+import unittest
+from math import cos, pi, sin
+
+import numpy
+import param
+
+from numbergen import NumberGenerator, ScaledTime, UniformRandom
+from imagen import Animation, Arc, Composite, Disk, Gabor, Gaussian, Line, Rectangle, \
+    Ring, Selector, SeparatedComposite, SineGrating, Sweeper, Translator, TwoRectangles, \
+    _CenterIndex
+from imagen.patterngenerator import KernelBank, PatternGenerator, PatternMemo, Transform, \
+    coordinate_cache, mask_cache
+from imagen.random import GaussianRandom
+from imagen.transferfn import Scale
+
+
+class Sequence(NumberGenerator):
+    """Returns the given values in turn, counting the values drawn."""
+
+    values = param.List(default=[])
+
+    def __init__(self,**params):
+        super(Sequence,self).__init__(**params)
+        self.draws = 0
+
+    def __call__(self):
+        value = self.values[self.draws]
+        self.draws += 1
+        return value
+
+
+class TestDynamicParameters(unittest.TestCase):
+
+    def test_orientation_drawn_once(self):
+        orientation = Sequence(values=[0.7,0.0,0.0])
+        pattern = Gaussian(orientation=orientation)()
+        self.assertEqual(orientation.draws,1)
+        self.assertTrue(numpy.allclose(pattern,Gaussian(orientation=0.7)()))
+
+    def test_axis_aligned_orientation_drawn_once(self):
+        orientation = Sequence(values=[0.0,0.7,0.7])
+        pattern = Gaussian(orientation=orientation)()
+        self.assertEqual(orientation.draws,1)
+        self.assertTrue(numpy.allclose(pattern,Gaussian(orientation=0.0)()))
+
+    def test_position_drawn_once(self):
+        x = Sequence(values=[-0.3,0.3,0.3])
+        y = Sequence(values=[0.2,-0.2,-0.2])
+        pattern = Gaussian(x=x,y=y)()
+        self.assertEqual((x.draws,y.draws),(1,1))
+        self.assertTrue(numpy.allclose(pattern,Gaussian(x=-0.3,y=0.2)()))
+
+    def test_support_window_at_drawn_position(self):
+        x = Sequence(values=[-0.3,-0.3,0.3])
+        pattern = Gaussian(x=x,support_tolerance=1e-3)()
+        self.assertEqual(x.draws,1)
+        self.assertTrue(numpy.allclose(pattern,Gaussian(x=-0.3)(),atol=1e-3))
+        self.assertTrue(pattern.max()>0.9)
+
+
+class KeptArray(PatternGenerator):
+    """Returns the same array, which it keeps, for every pattern."""
+
+    def function(self,p):
+        if not hasattr(self,'kept'):
+            self.kept = numpy.ones(self.pattern_x.shape)
+        return self.kept
+
+
+class TestOutArray(unittest.TestCase):
+
+    def test_drawn_into_out(self):
+        for pattern in (Gaussian(orientation=0.3,scale=2.0,offset=0.5),Disk(x=0.2),
+                        Composite(generators=[Gaussian(),Disk(x=0.2)])):
+            out = numpy.empty((10,10))
+            result = pattern(out=out,xdensity=10,ydensity=10)
+            self.assertTrue(result is out)
+            self.assertTrue(numpy.allclose(out,pattern(xdensity=10,ydensity=10)))
+
+    def test_out_dtype_mismatch(self):
+        out = numpy.empty((10,10),dtype=numpy.float32)
+        for pattern in (Gaussian(),Composite(generators=[Gaussian(),Disk(x=0.2)])):
+            self.assertRaises(ValueError,pattern,out=out,xdensity=10,ydensity=10)
+
+    def test_kept_array_not_modified(self):
+        kept = KeptArray()
+        for pattern in (KeptArray(scale=2.0,offset=0.5),
+                        Selector(generators=[kept],scale=2.0,offset=0.5)):
+            first = pattern(xdensity=10,ydensity=10)
+            self.assertTrue(numpy.array_equal(pattern(xdensity=10,ydensity=10),first))
+        self.assertTrue(numpy.array_equal(kept.kept,numpy.ones((10,10))))
+
+    def test_function_without_out(self):
+        # DoubledGaussian.function(self,p) predates the out argument
+        params = dict(size=0.2,orientation=0.3,xdensity=10,ydensity=10)
+        expected = 2*Gaussian(**params)()
+        out = numpy.empty((10,10))
+        self.assertTrue(numpy.allclose(DoubledGaussian(**params)(out=out),expected))
+        self.assertTrue(numpy.allclose(DoubledGaussian(support_tolerance=1e-3,**params)(),
+                                       expected,atol=1e-3))
+        composite = Composite(generators=[Gaussian(size=0.2),DoubledGaussian(size=0.2)],
+                              operator=numpy.add,xdensity=10,ydensity=10)
+        self.assertTrue(numpy.allclose(composite(),3*Gaussian(size=0.2,xdensity=10,ydensity=10)()))
+
+
+class TestDtype(unittest.TestCase):
+
+    def test_float32_patterns(self):
+        for pattern in (Gaussian(orientation=0.3),Gaussian(),Disk(x=0.2),
+                        Composite(generators=[Gaussian(),Disk(x=0.2)])):
+            single = pattern(dtype=numpy.float32,xdensity=10,ydensity=10)
+            self.assertEqual(single.dtype,numpy.float32)
+            self.assertTrue(numpy.allclose(single,pattern(xdensity=10,ydensity=10),atol=1e-6))
+
+
+class TestSupportTolerance(unittest.TestCase):
+
+    def test_compact_patterns(self):
+        for cls in (Gaussian,Gabor,Line,Disk,Ring,Rectangle,Arc):
+            pattern = cls(x=0.2,y=-0.1,orientation=0.6,size=0.2,xdensity=20,ydensity=20)
+            self.assertTrue(numpy.allclose(pattern(support_tolerance=1e-4),pattern(),atol=1e-4),
+                            cls.__name__)
+
+
+class TestCompositeCombination(unittest.TestCase):
+
+    def test_operators(self):
+        for scale in (1.0,-1.0):
+            generators = [Gaussian(x=0.1*i,size=0.1,scale=scale,support_tolerance=1e-3)
+                          for i in range(-3,4)]
+            patterns = [g(xdensity=20,ydensity=20) for g in generators]
+            for operator in (numpy.add,numpy.subtract,numpy.maximum,numpy.minimum,numpy.multiply):
+                composite = Composite(generators=generators,operator=operator,xdensity=20,ydensity=20)
+                self.assertTrue(numpy.allclose(composite(),operator.reduce(patterns)),operator)
+                out = numpy.empty((20,20))
+                self.assertTrue(numpy.allclose(composite(out=out),operator.reduce(patterns)),operator)
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.time_dependent = param.Dynamic.time_dependent
+        param.Dynamic.time_dependent = True
+
+    def tearDown(self):
+        param.Dynamic.time_dependent = self.time_dependent
+
+    def test_patterns_at_times(self):
+        time = param.Dynamic.time_fn()
+        gaussian = Gaussian(x=ScaledTime(factor=0.1),xdensity=10,ydensity=10)
+        patterns = [numpy.array(pattern) for pattern in gaussian.stream([0,1,2])]
+        for t,pattern in enumerate(patterns):
+            self.assertTrue(numpy.allclose(pattern,Gaussian(x=0.1*t,xdensity=10,ydensity=10)()))
+        self.assertEqual(param.Dynamic.time_fn(),time)
+
+    def test_into_out(self):
+        out = numpy.empty((10,10))
+        gaussian = Gaussian(x=ScaledTime(factor=0.1),xdensity=10,ydensity=10)
+        for pattern in gaussian.stream([2],out=out):
+            self.assertTrue(pattern is out)
+        self.assertTrue(numpy.allclose(out,Gaussian(x=0.2,xdensity=10,ydensity=10)()))
+
+
+class TestRenderBatch(unittest.TestCase):
+
+    def test_vectorized_patterns(self):
+        values = dict(x=[0.0,0.1,-0.2],y=[0.05,-0.1,0.2],orientation=[0.0,0.4,pi/2],
+                      scale=[1.0,2.0,0.5],offset=[0.0,0.1,-0.1])
+        for pattern in (Gaussian(aspect_ratio=0.5),SineGrating(),Disk(size=0.3)):
+            self.assertTrue(pattern._batch_vectorized)
+            batch = pattern.render_batch(xdensity=10,ydensity=10,**values)
+            for i in range(3):
+                single = pattern(xdensity=10,ydensity=10,
+                                 **dict((k,v[i]) for k,v in values.items()))
+                self.assertTrue(numpy.allclose(batch[i],single),(type(pattern).__name__,i))
+
+    def test_empty_batch(self):
+        for pattern in (Gaussian(),Composite(generators=[Gaussian()])):
+            for batch in (pattern.render_batch([],xdensity=10,ydensity=5),
+                          pattern.render_batch(x=[],xdensity=10,ydensity=5)):
+                self.assertEqual(batch.shape,(0,5,10))
+
+    def test_fallback_uses_dtype(self):
+        composite = Composite(generators=[Gaussian(),Disk()],dtype=numpy.float32,
+                              xdensity=10,ydensity=10)
+        batch = composite.render_batch(x=[0.0,0.1,0.2])
+        self.assertEqual(batch.dtype,numpy.float32)
+        self.assertTrue(numpy.array_equal(batch[1],composite(x=0.1)))
+
+    def test_output_fns_ignored(self):
+        gaussian = Gaussian(xdensity=10,ydensity=10)
+        for g in (gaussian,Composite(generators=[gaussian],xdensity=10,ydensity=10)):
+            batch = g.render_batch(x=[0.0,0.1],output_fns=[Scale(scale=2.0)])
+            self.assertTrue(numpy.allclose(batch[1],g(x=0.1)))
+            batch = g.render_batch([dict(x=0.0),dict(x=0.1,output_fns=[Scale(scale=2.0)])])
+            self.assertTrue(numpy.allclose(batch[1],g(x=0.1)))
+
+
+class TestParallelComposite(unittest.TestCase):
+
+    def test_repeated_generator(self):
+        gaussian = Gaussian(size=0.1)
+        generators = [gaussian]*8
+        serial = Composite(generators=generators,xdensity=20,ydensity=20)()
+        threaded = Composite(generators=generators,parallel='threads',workers=4,
+                             xdensity=20,ydensity=20)
+        for i in range(20):
+            self.assertTrue(numpy.allclose(threaded(),serial))
+
+    def test_nested(self):
+        def composite(**params):
+            return Composite(generators=[Composite(generators=[Gaussian(x=0.1*i,y=0.1*j)
+                                                              for j in range(3)],**params)
+                                         for i in range(3)],xdensity=20,ydensity=20,**params)
+        self.assertTrue(numpy.allclose(composite(parallel='threads',workers=2)(),composite()()))
+
+    def test_in_animation_processes(self):
+        pattern = Composite(generators=[Gaussian(x=0.1*i) for i in range(4)],
+                            parallel='threads',workers=2,xdensity=10,ydensity=10)
+        pattern()
+        frames = Animation(pattern=pattern,frames=3,processes=2)
+        for frame in frames.values():
+            self.assertTrue(numpy.allclose(frame.data,pattern()))
+
+    def test_random_in_animation_processes(self):
+        dynamic_time_dependent = param.Dynamic.time_dependent
+        param.Dynamic.time_dependent = True
+        try:
+            for time_dependent in (False,True):
+                def frames(processes):
+                    noise = GaussianRandom(seed=1,time_dependent=time_dependent,name='noise',
+                                           xdensity=10,ydensity=10)
+                    return [frame.data for frame in
+                            Animation(pattern=noise,frames=3,processes=processes).values()]
+                concurrent = frames(2)
+                self.assertFalse(numpy.allclose(concurrent[0],concurrent[1]))
+                self.assertTrue(numpy.allclose(concurrent,frames(None)))
+        finally:
+            param.Dynamic.time_dependent = dynamic_time_dependent
+
+
+class TestTransform(unittest.TestCase):
+
+    def test_composition(self):
+        parent = Transform(0.2,-0.1,0.7,1.5)
+        child = Transform(-0.3,0.4,-1.2,0.5)
+        def affine(t):
+            return numpy.vstack((t.matrix,[0.0,0.0,1.0]))
+        self.assertTrue(numpy.allclose(affine(parent*child),affine(parent).dot(affine(child))))
+        self.assertTrue(numpy.allclose((parent*child)(0.1,0.2),parent(*child(0.1,0.2))))
+        self.assertAlmostEqual((parent*child).cos,cos(0.7-1.2))
+        self.assertAlmostEqual((parent*child).sin,sin(0.7-1.2))
+
+    def test_composite_placement(self):
+        child = Gaussian(x=0.2,y=0.1,orientation=0.3,size=0.2,aspect_ratio=2.0)
+        composite = Composite(generators=[child],x=-0.1,y=0.05,orientation=1.1,size=1.5,
+                              xdensity=20,ydensity=20)
+        # The child's offset, rotated and scaled by the composite's
+        x = -0.1+1.5*(0.2*cos(1.1)-0.1*sin(1.1))
+        y = 0.05+1.5*(0.2*sin(1.1)+0.1*cos(1.1))
+        self.assertTrue(numpy.allclose(composite(),child(x=x,y=y,orientation=1.4,size=0.3,
+                                                         xdensity=20,ydensity=20)))
+
+
+class GridComposite(Composite):
+    """Composite whose function uses the coordinate grids."""
+
+    def function(self,p,out=None):
+        return self.pattern_x+super(GridComposite,self).function(p)
+
+
+class TestCoordinateGrids(unittest.TestCase):
+
+    def test_grids_shared_and_read_only(self):
+        first = Gaussian(orientation=0.3,x=0.1,xdensity=10,ydensity=10)
+        second = Gaussian(orientation=0.3,x=0.1,xdensity=10,ydensity=10)
+        first(); second()
+        self.assertTrue(first.pattern_x is second.pattern_x)
+        self.assertFalse(first.pattern_x.flags.writeable)
+
+    def test_cached_grids_give_same_pattern(self):
+        gaussian = Gaussian(orientation=0.3,x=0.1,xdensity=10,ydensity=10)
+        coordinate_cache.clear()
+        first = gaussian()
+        self.assertEqual(coordinate_cache.hits,0)
+        self.assertTrue(numpy.array_equal(gaussian(),first))
+        self.assertTrue(coordinate_cache.hits>0)
+
+    def test_composite_subclass_gets_grids(self):
+        pattern = GridComposite(generators=[Gaussian()],xdensity=10,ydensity=10)
+        self.assertTrue(numpy.allclose(pattern(),Gaussian(xdensity=10,ydensity=10)()+
+                                       pattern.pattern_x))
+        self.assertEqual(pattern.pattern_x.shape,(10,10))
+
+
+class ScaledDisk(Disk):
+    """Disk scaled by the first of a list of factors."""
+
+    factors = param.List(default=[1.0])
+
+    def function(self,p,out=None):
+        return Disk.function(self,p)*p.factors[0]
+
+
+class CountingDisk(Disk):
+    """Disk counting the times it is drawn."""
+
+    def __init__(self,**params):
+        super(CountingDisk,self).__init__(**params)
+        self.draws = 0
+
+    def function(self,p):
+        self.draws += 1
+        return Disk.function(self,p)
+
+
+class TestMaskCache(unittest.TestCase):
+
+    def test_repeated_draw(self):
+        disk = CountingDisk(size=0.5)
+        gaussian = Gaussian(size=10.0,mask_shape=disk,xdensity=10,ydensity=10)
+        first = gaussian()
+        before = mask_cache.info()
+        for i in range(3):
+            self.assertTrue(numpy.array_equal(gaussian(),first))
+        after = mask_cache.info()
+        self.assertEqual(disk.draws,1)
+        self.assertEqual((after['misses']-before['misses'],after['hits']-before['hits']),(0,3))
+
+    def test_unhashable_values(self):
+        for i in range(1,20):
+            factor = 1.0/i
+            pattern = Gaussian(size=10.0,mask_shape=ScaledDisk(factors=[factor]),
+                               xdensity=10,ydensity=10)()
+            self.assertAlmostEqual(pattern.max(),factor,places=3)
+
+
+def unseparated(cls):
+    """Return a subclass of cls that is always drawn from the full grids."""
+    def rotate(self,x,y,orientation):
+        return PatternGenerator._create_and_rotate_coordinate_arrays(self,x,y,orientation)
+    return type('Unseparated'+cls.__name__,(cls,),{'_create_and_rotate_coordinate_arrays':rotate})
+
+
+class TestSeparable(unittest.TestCase):
+
+    def test_axis_aligned_patterns(self):
+        for cls in (Gaussian,SineGrating,Gabor,Rectangle,TwoRectangles):
+            for orientation in (0.0,pi/2,pi,3*pi/2):
+                params = dict(x=0.12,y=-0.07,size=0.33,orientation=orientation,
+                              xdensity=20,ydensity=20)
+                if 'aspect_ratio' in cls.params():
+                    params['aspect_ratio'] = 0.7
+                self.assertTrue(numpy.allclose(cls(**params)(),unseparated(cls)(**params)()),
+                                (cls.__name__,orientation))
+
+
+    def test_overridden_function(self):
+        params = dict(size=0.2,orientation=0.0,xdensity=20,ydensity=20)
+        doubled = DoubledGaussian(**params)
+        self.assertTrue(numpy.allclose(doubled(),2*Gaussian(**params)()))
+        self.assertTrue(numpy.allclose(doubled(support_tolerance=1e-3),2*Gaussian(**params)(),
+                                       atol=1e-3))
+        self.assertTrue(numpy.allclose(ConstantGrating(**params)(),7.0))
+
+
+class DoubledGaussian(Gaussian):
+    """Gaussian subclass overriding function(), but not _separable."""
+
+    def function(self,p):
+        return 2*Gaussian.function(self,p)
+
+
+class ConstantGrating(SineGrating):
+    """SineGrating subclass overriding function(), but not _separable."""
+
+    def function(self,p):
+        return 7.0*numpy.ones(self.pattern_x.shape)
+
+
+class TestKernelBank(unittest.TestCase):
+
+    def test_translated_patterns(self):
+        bank = KernelBank()
+        gabor = Gabor(orientation=0.4,size=0.3,xdensity=10,ydensity=10)
+        for x,y in ((0.0,0.0),(0.1,-0.2),(-0.3,0.3)):
+            banked = gabor(x=x,y=y,kernel_bank=bank,scale=2.0)
+            self.assertTrue(numpy.allclose(banked,gabor(x=x,y=y,scale=2.0)))
+        self.assertEqual((bank.info()['misses'],bank.info()['hits']),(1,2))
+        # Between matrix units
+        self.assertTrue(numpy.allclose(gabor(x=0.05,kernel_bank=bank),gabor(x=0.05)))
+        self.assertEqual(bank.info()['misses'],2)
+
+    def test_unhashable_values(self):
+        bank = KernelBank()
+        for i in range(1,20):
+            factor = 1.0/i
+            pattern = ScaledDisk(factors=[factor],kernel_bank=bank,xdensity=10,ydensity=10)()
+            self.assertAlmostEqual(pattern.max(),factor)
+
+
+class TestLazyAnimation(unittest.TestCase):
+
+    def animation(self):
+        return Animation(pattern=Gaussian(xdensity=5,ydensity=5),frames=1000,lazy=True)
+
+    def test_slice_generates_selected_frames(self):
+        anim = self.animation()
+        sliced = anim[10:13]
+        self.assertEqual(sliced.keys(),[10,11,12])
+        self.assertEqual(anim._data.cache.misses,3)
+
+    def test_items_generates_frames_on_access(self):
+        anim = self.animation()
+        items = anim.items()
+        self.assertEqual(len(items),1000)
+        self.assertEqual(anim._data.cache.misses,0)
+        key, frame = items[5]
+        self.assertEqual(key,5)
+        self.assertEqual(anim._data.cache.misses,1)
+
+
+class TestPatternMemo(unittest.TestCase):
+
+    def test_selector(self):
+        memo = PatternMemo()
+        generators = [Gaussian(orientation=0.3,size=0.3),Disk(x=0.2,size=0.3)]
+        selector = Selector(generators=generators,memo=memo,xdensity=10,ydensity=10)
+        plain = Selector(generators=generators,xdensity=10,ydensity=10)
+        for index in (0.0,0.6,0.0,0.6):
+            pattern = selector(index=index)
+            self.assertTrue(numpy.array_equal(pattern,plain(index=index)))
+            self.assertTrue(pattern.flags.writeable)
+        self.assertEqual((memo.info()['misses'],memo.info()['hits']),(2,2))
+
+    def test_sweeper(self):
+        memo = PatternMemo()
+        generator = Gaussian(size=0.3)
+        sweeper = Sweeper(generator=generator,memo=memo,xdensity=10,ydensity=10)
+        plain = Sweeper(generator=generator,xdensity=10,ydensity=10)
+        for step in (1,2,1):
+            self.assertTrue(numpy.array_equal(sweeper(step=step),plain(step=step)))
+        self.assertEqual(memo.info()['hits'],1)
+
+    def test_changed_parameter(self):
+        memo = PatternMemo()
+        generator = Gaussian(size=0.3)
+        selector = Selector(generators=[generator],memo=memo,xdensity=10,ydensity=10)
+        selector()
+        generator.size = 0.5
+        self.assertTrue(numpy.array_equal(selector(),generator(xdensity=10,ydensity=10)))
+
+
+class TestSeparatedComposite(unittest.TestCase):
+
+    def test_center_index(self):
+        rng = numpy.random.RandomState(3)
+        index = _CenterIndex(0.1)
+        points = []
+        for x,y in rng.uniform(-1,1,(300,2)):
+            clear = all(numpy.hypot(x-px,y-py)>=0.1 for px,py in points)
+            self.assertEqual(index.clear_of(x,y),clear)
+            if clear:
+                index.add(x,y)
+                points.append((x,y))
+
+    def test_separation(self):
+        generators = [Gaussian(x=UniformRandom(lbound=-0.5,ubound=0.5,seed=i),
+                               y=UniformRandom(lbound=-0.5,ubound=0.5,seed=100+i))
+                      for i in range(20)]
+        composite = SeparatedComposite(generators=generators,min_separation=0.2)
+        accepted = composite._advance_pattern_generators(composite)
+        self.assertTrue(len(accepted)>1)
+        centers = [(g.inspect_value('x'),g.inspect_value('y')) for g in accepted]
+        for i,(x,y) in enumerate(centers):
+            for px,py in centers[:i]:
+                self.assertTrue(numpy.hypot(x-px,y-py)>=0.2)
+
+
+class TestIncrementalTranslator(unittest.TestCase):
+
+    def translator(self,**params):
+        params.setdefault('generator',Gaussian(size=0.2))
+        return Translator(xdensity=10,ydensity=10,**params)
+
+    def test_generator_replaced(self):
+        translator = self.translator(incremental='nearest')
+        translator()
+        translator.generator = Disk(size=0.2)
+        self.assertTrue(numpy.allclose(translator(),self.translator(generator=Disk(size=0.2))()))
+
+    def test_generator_overridden(self):
+        translator = self.translator(incremental='nearest')
+        translator()
+        disk = Disk(size=0.2)
+        self.assertTrue(numpy.allclose(translator(generator=disk),
+                                       self.translator(generator=disk)()))
+
+    def test_generator_parameter_changed(self):
+        translator = self.translator(incremental='nearest')
+        translator()
+        translator.generator.size = 0.4
+        self.assertTrue(numpy.allclose(translator(),self.translator(generator=Gaussian(size=0.4))()))
+
+    def test_matches_direct_drawing(self):
+        def patterns(incremental):
+            time = param.Time(time_type=float)
+            translator = Translator(generator=Gaussian(size=0.3,aspect_ratio=2.0,orientation=0.3),
+                                    x=UniformRandom(lbound=-0.2,ubound=0.2,seed=1),
+                                    y=UniformRandom(lbound=-0.2,ubound=0.2,seed=2),
+                                    direction=UniformRandom(lbound=-pi,ubound=pi,seed=3),
+                                    speed=0.05,reset_period=4,time_fn=time,
+                                    incremental=incremental,xdensity=20,ydensity=20)
+            # Two episodes, with new x, y, and direction values
+            for t in range(9):
+                time(float(t))
+                yield translator()
+        direct = list(patterns(None))
+        for incremental,tolerance in (('nearest',0.1),('linear',0.02)):
+            for t,pattern in enumerate(patterns(incremental)):
+                self.assertTrue(numpy.allclose(pattern,direct[t],atol=tolerance),(incremental,t))
+
+
+if __name__ == "__main__":
+    import nose
+    nose.runmodule(argv=[sys.argv[0], "--logging-level", "ERROR"])
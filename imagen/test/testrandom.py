@@ -0,0 +1,62 @@
+"""
+Test cases for imagen.random
+"""
+
+import sys
+import unittest
+
+import numpy
+
+from imagen.random import GaussianRandom, RandomDotStereogram, _paint_squares
+
+
+class TestRandomStreams(unittest.TestCase):
+
+    def test_seeded_streams(self):
+        params = dict(seed=5,xdensity=5,ydensity=5)
+        first = GaussianRandom(**params)
+        second = GaussianRandom(**params)
+        shared = GaussianRandom(xdensity=5,ydensity=5)
+        for i in range(3):
+            shared()
+            self.assertTrue(numpy.array_equal(first(),second()))
+
+    def test_spawn(self):
+        values = [stream.uniform(size=5) for stream in GaussianRandom(seed=5).spawn(2)]
+        again = [stream.uniform(size=5) for stream in GaussianRandom(seed=5).spawn(2)]
+        self.assertFalse(numpy.array_equal(values[0],values[1]))
+        self.assertTrue(numpy.array_equal(values,again))
+
+    def test_batch(self):
+        params = dict(seed=5,xdensity=5,ydensity=5)
+        batch = GaussianRandom(**params).render_batch(x=[0.0,0.1,0.2])
+        noise = GaussianRandom(**params)
+        for pattern in batch:
+            self.assertTrue(numpy.array_equal(pattern,noise()))
+
+
+class TestRandomDotStereogram(unittest.TestCase):
+
+    def test_paint_squares(self):
+        rng = numpy.random.RandomState(5)
+        for size in (1,2,3,5):
+            rows = rng.randint(-2*size,20+size,60)
+            cols = rng.randint(-2*size,25+size,60)
+            values = rng.uniform(-1,1,60)
+            expected = numpy.zeros((20,25))
+            # Painted in turn, later squares covering earlier ones
+            for r,c,v in zip(rows,cols,values):
+                expected[max(r,0):max(r+size,0),max(c,0):max(c+size,0)] = v
+            self.assertTrue(numpy.array_equal(_paint_squares((20,25),rows,cols,size,values),
+                                              expected),size)
+
+    def test_disparity(self):
+        stereogram = RandomDotStereogram(xdensity=40,ydensity=40,dotsize=0.1)
+        left = stereogram(xdisparity=0.0)
+        right = stereogram(xdisparity=0.1)
+        self.assertTrue(numpy.array_equal(left[:,4:],right[:,:-4]))
+
+
+if __name__ == "__main__":
+    import nose
+    nose.runmodule(argv=[sys.argv[0], "--logging-level", "ERROR"])
@@ -5,9 +5,12 @@ __version__='$Revision: 8943 $'
 
 import random
 import operator
+import itertools
 
 from math import e,pi
 
+import numpy
+
 import param
 
 
@@ -93,6 +96,41 @@ class NumberGenerator(param.Parameterized):
     def __call__(self):
         raise NotImplementedError
 
+
+    def sample(self,n):
+        """
+        Return an array of the values of n successive calls, i.e. the
+        next n values of this generator.
+        """
+        return numpy.array([self() for i in xrange(n)])
+
+
+    def sample_times(self,times):
+        """
+        Return an array of the values of this generator at each of the
+        given times, in turn, as set on its time_fn (or on
+        param.Dynamic.time_fn if it has none).  The time is restored
+        afterwards.
+
+        The generator is simply called once at each time, so this is
+        a convenience rather than a faster way to get the values.
+        """
+        values = []
+        with getattr(self,'time_fn',param.Dynamic.time_fn) as t:
+            for time in times:
+                t(time)
+                values.append(self())
+        return numpy.array(values)
+
+
+    def compile(self):
+        """
+        Return a CompiledExpression evaluating this generator, which
+        is faster to evaluate when this generator is an expression
+        combining others with operators.
+        """
+        return CompiledExpression(self)
+
     # Could define any of Python's operators here, esp. if they have operator or ufunc equivalents
     def __add__      (self,operand): return BinaryOperator(self,operand,operator.add)
     def __sub__      (self,operand): return BinaryOperator(self,operand,operator.sub)
@@ -169,6 +207,170 @@ class UnaryOperator(NumberGenerator):
         return self.operator(self.operand(),**self.args)
 
 
+class CompiledExpression(NumberGenerator):
+    """
+    Flattened form of an expression built from NumberGenerators (or
+    other callables) and numbers with operators, such as abs((x+y)/z),
+    giving the same values as the expression itself.
+
+    The tree of BinaryOperators and UnaryOperators is compiled once
+    into a list of steps, each applying one operator to the values of
+    earlier steps, so that evaluation does not recurse through the
+    tree.  Operators whose operands are all numbers are applied only
+    once, when compiling.  Subexpressions whose value is fixed for a
+    given time (because all the generators they use are
+    time_dependent) are evaluated only once per evaluation, however
+    often they appear.  Other generators are called once for each
+    appearance, as in the expression itself.
+
+    The sample() and sample_times() methods draw the values of each
+    generator for all the samples or times first (using the
+    generator's own sample() or sample_times(), which for
+    time_dependent generators still calls the generator at each
+    time), then apply each step to whole arrays of values at once.
+    (Generators are then no longer called in interleaved order, so
+    they must not share random state.)
+
+    Note that changes to the structure of the expression after
+    compiling are not reflected in the CompiledExpression, although
+    changes to the parameters of the generators it uses are.
+    """
+
+    def __init__(self,expression,**params):
+        super(CompiledExpression,self).__init__(**params)
+        self.expression = expression
+        self._constants = {}   # slot: value
+        self._calls = []       # (slot,generator), in the order called by the expression
+        self._steps = []       # (slot,op,argument slots,keyword arguments)
+        self._time_fixed = set()
+        self._shared = {}
+        self._result = self._compile(expression)
+
+
+    def _slot(self):
+        return len(self._constants)+len(self._calls)+len(self._steps)
+
+
+    def _compile(self,node):
+        """Add the steps for evaluating node, returning the slot of its value."""
+        if isinstance(node,CompiledExpression):
+            return self._compile(node.expression)
+
+        if isinstance(node,BinaryOperator):
+            lhs = self._compile(node.lhs)
+            return self._step(node.operator,(lhs,self._compile(node.rhs)),node.args)
+
+        if isinstance(node,UnaryOperator):
+            return self._step(node.operator,(self._compile(node.operand),),node.args)
+
+        slot = self._slot()
+        if not callable(node):
+            try:
+                key = ('constant',type(node),node,repr(node))
+                if key in self._shared:
+                    return self._shared[key]
+                self._shared[key] = slot
+            except TypeError:
+                pass
+            self._constants[slot] = node
+        elif _time_fixed(node):
+            key = ('generator',id(node))
+            if key in self._shared:
+                return self._shared[key]
+            self._shared[key] = slot
+            self._time_fixed.add(slot)
+            self._calls.append((slot,node))
+        else:
+            self._calls.append((slot,node))
+        return slot
+
+
+    def _step(self,op,args,kwargs):
+        if all(a in self._constants for a in args):
+            slot = self._slot()
+            self._constants[slot] = op(*[self._constants[a] for a in args],**kwargs)
+            return slot
+
+        shareable = all(a in self._constants or a in self._time_fixed for a in args)
+        key = (op,args,tuple(sorted(kwargs.items())))
+        if shareable and key in self._shared:
+            return self._shared[key]
+
+        slot = self._slot()
+        self._steps.append((slot,op,args,kwargs))
+        if shareable:
+            self._shared[key] = slot
+            self._time_fixed.add(slot)
+        return slot
+
+
+    def _evaluate(self,values):
+        """Apply the steps, given the values of the generators, and return the result."""
+        values.update(self._constants)
+        for slot,op,args,kwargs in self._steps:
+            values[slot] = op(*[values[a] for a in args],**kwargs)
+        return values[self._result]
+
+
+    def __call__(self):
+        return self._evaluate(dict((slot,generator()) for slot,generator in self._calls))
+
+
+    def sample(self,n):
+        if self._result in self._constants:
+            return numpy.array([self._constants[self._result]]*n)
+        return self._evaluate(self._generator_values(n))
+
+
+    def sample_times(self,times):
+        if self._result in self._constants:
+            return numpy.array([self._constants[self._result]]*len(times))
+        return self._evaluate(self._generator_values(len(times),times))
+
+
+    def _generator_values(self,n,times=None):
+        """
+        Return a dictionary of arrays of n values for each generator
+        call, either the next n values or those at each of the times.
+        """
+        calls = {}
+        for slot,generator in self._calls:
+            calls.setdefault(id(generator),(generator,[]))[1].append(slot)
+
+        values = {}
+        for generator,slots in calls.values():
+            k = len(slots)
+            if isinstance(generator,NumberGenerator) and (slots[0] in self._time_fixed or
+                                                          isinstance(generator,RandomDistribution)):
+                # Values are either fixed at each time, or independent of time
+                if slots[0] in self._time_fixed:
+                    samples = generator.sample_times(times) if times is not None else generator.sample(n)
+                else:
+                    samples = generator.sample(n*k)
+                samples = samples.reshape((n,k))
+            elif times is None:
+                samples = numpy.array([[generator() for slot in slots]
+                                       for i in xrange(n)]).reshape((n,k))
+            else:
+                samples = []
+                with getattr(generator,'time_fn',param.Dynamic.time_fn) as t:
+                    for time in times:
+                        t(time)
+                        samples.append([generator() for slot in slots])
+                samples = numpy.array(samples).reshape((n,k))
+            for j,slot in enumerate(slots):
+                values[slot] = samples[:,j]
+        return values
+
+
+
+def _time_fixed(generator):
+    """Return True if the value of generator is fixed for any given time."""
+    return isinstance(generator,TimeDependent) or \
+        (isinstance(generator,TimeAware) and generator.time_dependent)
+
+
+
 class RandomDistribution(NumberGenerator, TimeAware):
     """
     Python's random module provides the Random class, which can be
@@ -260,6 +462,39 @@ class RandomDistribution(NumberGenerator, TimeAware):
             self._hash_and_seed()
 
 
+    def sample(self,n):
+        """
+        Return an array of the next n values, as for n successive
+        calls.  If time_dependent, all n values are the value for the
+        current time.
+        """
+        if self.time_dependent:
+            return numpy.array([self()]*n)
+        return super(RandomDistribution,self).sample(n)
+
+
+    def sample_times(self,times):
+        """
+        Return an array of the values at each of the given times.
+        Unless time_dependent, the values do not depend on the time
+        and are simply the next len(times) values.  If time_dependent,
+        the stream is reseeded for each time in turn, and each value
+        is drawn by a separate call.
+        """
+        if not self.time_dependent:
+            return self.sample(len(times))
+        return super(RandomDistribution,self).sample_times(times)
+
+
+    def _random_sample(self,n):
+        """
+        Return an array of the next n values of random_generator's
+        random(), as n successive calls would give.
+        """
+        return numpy.fromiter(itertools.islice(iter(self.random_generator.random,None),n),
+                              dtype=float,count=n)
+
+
 
 class UniformRandom(RandomDistribution):
     """
@@ -279,6 +514,13 @@ class UniformRandom(RandomDistribution):
         return self.random_generator.uniform(self.lbound,self.ubound)
 
 
+    def sample(self,n):
+        if self.time_dependent:
+            return super(UniformRandom, self).sample(n)
+        # As random.uniform, for each value
+        return self.lbound + (self.ubound-self.lbound)*self._random_sample(n)
+
+
 
 class UniformRandomOffset(RandomDistribution):
     """
@@ -302,6 +544,14 @@ class UniformRandomOffset(RandomDistribution):
                 self.mean + self.range / 2.0)
 
 
+    def sample(self,n):
+        if self.time_dependent:
+            return super(UniformRandomOffset, self).sample(n)
+        # As random.uniform, for each value
+        a,b = self.mean - self.range / 2.0, self.mean + self.range / 2.0
+        return a + (b-a)*self._random_sample(n)
+
+
 
 class UniformRandomInt(RandomDistribution):
     """
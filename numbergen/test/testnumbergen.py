@@ -0,0 +1,68 @@
+"""
+Test cases for numbergen
+"""
+
+import sys
+import unittest
+
+import numpy
+import param
+
+from numbergen import CompiledExpression, UniformRandom, UniformRandomOffset, NormalRandom, \
+    ScaledTime
+
+
+class TestSample(unittest.TestCase):
+
+    def test_sample_matches_calls(self):
+        for cls in (UniformRandom,UniformRandomOffset,NormalRandom):
+            values = cls(seed=3).sample(10)
+            generator = cls(seed=3)
+            self.assertTrue(numpy.allclose(values,[generator() for i in range(10)]),cls.__name__)
+
+    def test_sample_times(self):
+        time = param.Time(until=10)
+        scaled = ScaledTime(factor=0.5,time_fn=time)
+        self.assertTrue(numpy.allclose(scaled.sample_times([1,2,4]),[0.5,1.0,2.0]))
+        self.assertEqual(time(),0)
+
+    def test_time_dependent_sample_times(self):
+        time = param.Time(until=10)
+        generator = UniformRandom(name='test_time_dependent',time_dependent=True,time_fn=time)
+        values = generator.sample_times([1,2,1])
+        self.assertEqual(values[0],values[2])
+        self.assertNotEqual(values[0],values[1])
+        self.assertTrue(numpy.array_equal(generator.sample(3),[generator()]*3))
+
+
+class TestCompiledExpression(unittest.TestCase):
+
+    def expression(self,seed):
+        x = UniformRandom(seed=seed)
+        y = NormalRandom(seed=seed+1)
+        return abs((x+y*2)/(x-3))+(2**3)
+
+    def test_values(self):
+        compiled = CompiledExpression(self.expression(1))
+        expression = self.expression(1)
+        for i in range(5):
+            self.assertAlmostEqual(compiled(),expression())
+
+    def test_sample(self):
+        values = self.expression(1).compile().sample(5)
+        expression = self.expression(1)
+        self.assertTrue(numpy.allclose(values,[expression() for i in range(5)]))
+
+    def test_time_fixed_shared(self):
+        time = param.Time(until=10)
+        scaled = ScaledTime(factor=0.5,time_fn=time)
+        compiled = CompiledExpression((scaled+1)*(scaled+1)-scaled)
+        self.assertEqual(len(compiled._calls),1)
+        time(4)
+        self.assertEqual(compiled(),7.0)
+        self.assertTrue(numpy.allclose(compiled.sample_times([0,2]),[1.0,3.0]))
+
+
+if __name__ == "__main__":
+    import nose
+    nose.runmodule(argv=[sys.argv[0], "--logging-level", "ERROR"])